@@ -6,16 +6,16 @@ sys.path.append(os.getcwd())
 
 from engine import templates
 
-# Mock Inventory matches User's case
+# Mock Inventory matches User's case (role -> path, as produced by scan_directory)
 inventory = {
-  "towel_hero.png": "hero",
-  "bag_large.png": "support_large",
-  "frame_medium.png": "support_medium_large",
-  "greeting_medium.png": "support_medium_large",
-  "notebook_medium.png": "support_medium_large",
-  "magnet_small.png": "accessory_small",
-  "mug_small.png": "accessory_small",
-  "keyring_tiny.png": "accessory_tiny"
+  "hero": "towel_hero.png",
+  "support_large": "bag_large.png",
+  "support_medium_large": "frame_medium.png",
+  "support_medium_large_2": "greeting_medium.png",
+  "support_medium_large_3": "notebook_medium.png",
+  "accessory_small": "magnet_small.png",
+  "accessory_small_2": "mug_small.png",
+  "accessory_tiny": "keyring_tiny.png"
 }
 
 config = {} # dummy
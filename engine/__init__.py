@@ -1,6 +1,22 @@
 # Engine package initialization
-from .layout_brain import LayoutBrain
-from .layout_solver import LayoutSolver
-from .layout_designer import LayoutDesigner
-from .smart_renderer import render_smart_storyboard
-from .templates import get_valid_templates
+# Re-exports resolve lazily (PEP 562) so importing a lightweight submodule such
+# as engine.image_cache doesn't pull in google-genai via LayoutBrain.
+import importlib
+
+_EXPORTS = {
+    "LayoutBrain": ".layout_brain",
+    "LayoutSolver": ".layout_solver",
+    "LayoutDesigner": ".layout_designer",
+    "render_smart_storyboard": ".smart_renderer",
+    "get_valid_templates": ".templates",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
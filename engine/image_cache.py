@@ -0,0 +1,136 @@
+"""
+Cache of decoded and fitted product images (safe to call from worker threads).
+
+Fitting a product to a zone (decode, RGBA conversion, resize) is the dominant
+per-zone cost and is identical across zones and runs as long as the source
+file and target size don't change. Fitted images are kept in an in-memory LRU
+keyed on (path, mtime, zone width, zone height, resample filter) and written
+on first use under CACHE_DIR (.cache/resized by default; override with the
+SBG_CACHE_DIR environment variable or set_cache_dir()), so repeated CLI runs
+only decode the zone-sized file. A cached file is used while it is newer than
+its source. The disk cache is best-effort: if it can't be written (read-only
+or full disk), the fitted image is still returned from memory.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+
+from .image_utils import fit_image_to_zone
+
+CACHE_DIR = os.environ.get("SBG_CACHE_DIR", os.path.join(".cache", "resized"))
+MAX_ENTRIES = 256
+
+_FITTED = OrderedDict()  # key -> (image, x_offset, y_offset), least recently used first
+_LOCK = threading.Lock()  # guards _FITTED; decoding and fitting run outside it
+
+
+def set_cache_dir(path):
+    """Write (and look up) zone-sized cache files under `path` from now on."""
+    global CACHE_DIR
+    CACHE_DIR = path
+
+
+def resized_path(path, w, h, resample_filter="auto"):
+    """
+    Location of the zone-sized cache file for the product at `path`.
+    The source directory is hashed into the name so same-named products from
+    different folders don't collide in the shared cache directory.
+    """
+    folder, name = os.path.split(os.path.abspath(path))
+    folder_key = hashlib.sha1(folder.encode()).hexdigest()[:12]
+    return os.path.join(CACHE_DIR, f"{name}_{folder_key}_{w}x{h}_{resample_filter}.png")
+
+
+def _read_resized(cache_path, src_mtime):
+    """Fitted entry from a cache file, or None if it is missing or stale."""
+    try:
+        if os.path.getmtime(cache_path) < src_mtime:
+            return None
+        img = Image.open(cache_path)
+        img.load()
+        x_off, y_off = (int(v) for v in img.info["offset"].split(","))
+        return img, x_off, y_off
+    except Exception:
+        return None
+
+
+def _write_resized(cache_path, fitted, x_off, y_off):
+    """
+    Write a fitted entry atomically (parallel renders may race on it).
+    Never raises: a failed write only costs the next run a re-fit.
+    """
+    info = PngInfo()
+    info.add_text("offset", f"{x_off},{y_off}")
+    tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        fitted.save(tmp_path, format="PNG", pnginfo=info, compress_level=3)
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        print(f"[WARN] Failed to write resized product {cache_path}: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def get_fitted(path, w, h, resample_filter="auto"):
+    """
+    Product image at `path` fitted into a w x h zone.
+    
+    Fully transparent borders are trimmed once here (offsets adjusted to
+    match), so every later composite only blends pixels that can change the
+    canvas. Products whose alpha is fully opaque after fitting (JPEG mockups,
+    flattened PNGs) come back as RGB so callers can paste them directly.
+    
+    Returns:
+        Tuple of (RGBA or RGB image, x_offset, y_offset). The image is shared
+        with the cache, so treat it as read-only.
+    """
+    mtime = os.path.getmtime(path)
+    key = (os.path.abspath(path), mtime, w, h, resample_filter)
+    with _LOCK:
+        if key in _FITTED:
+            _FITTED.move_to_end(key)
+            return _FITTED[key]
+    
+    cache_path = resized_path(path, w, h, resample_filter)
+    result = _read_resized(cache_path, mtime)
+    if result is None:
+        result = _fit(path, w, h, resample_filter)
+        _write_resized(cache_path, *result)
+    
+    with _LOCK:
+        _FITTED[key] = result
+        if len(_FITTED) > MAX_ENTRIES:
+            _FITTED.popitem(last=False)
+    return result
+
+
+def _fit(path, w, h, resample_filter):
+    """Decode, fit, trim and (when opaque) flatten one product."""
+    img = Image.open(path)
+    if img.format == "JPEG":
+        # Decode at reduced DCT scale, keeping >= 2x the zone for the resize
+        img.draft("RGB", (w * 2, h * 2))
+    # RGB/RGBA resize as-is (RGB has nothing to trim or composite); only
+    # other modes are converted, before the resize so palettes keep alpha
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA")
+    fitted, x_off, y_off = fit_image_to_zone(img, w, h, resample_filter)
+    
+    if fitted.mode == "RGBA":
+        bbox = fitted.getbbox()
+        if bbox and bbox != (0, 0) + fitted.size:
+            fitted = fitted.crop(bbox)
+            x_off += bbox[0]
+            y_off += bbox[1]
+        if fitted.getchannel("A").getextrema() == (255, 255):
+            fitted = fitted.convert("RGB")
+    return fitted, x_off, y_off
+
@@ -5,6 +5,22 @@ Provides consistent image processing across all renderers.
 
 from PIL import Image
 
+# Optional OpenCV resampler for LANCZOS resizes (falls back to Pillow)
+try:
+    import cv2
+    import numpy as np
+    CV2_AVAILABLE = True
+except ImportError:
+    CV2_AVAILABLE = False
+
+
+# Config "resample_filter" values; "auto" picks per resize (see fit_image_to_zone)
+RESAMPLE_FILTERS = {
+    "nearest": Image.Resampling.NEAREST,
+    "bilinear": Image.Resampling.BILINEAR,
+    "bicubic": Image.Resampling.BICUBIC,
+    "lanczos": Image.Resampling.LANCZOS,
+}
 
 def fit_image_to_box(img, max_width, max_height, maintain_aspect=True):
     """
@@ -70,3 +86,62 @@ def get_centering_offset(image_size, container_size):
     y_offset = (container_h - img_h) // 2
     
     return x_offset, y_offset
+
+
+def _cv2_lanczos(img, size):
+    """
+    LANCZOS resize through cv2.INTER_LANCZOS4, matching Pillow's handling of
+    RGBA by resampling premultiplied alpha (no dark fringes at soft edges).
+    """
+    src = img.convert("RGBa") if img.mode == "RGBA" else img
+    arr = cv2.resize(np.asarray(src), size, interpolation=cv2.INTER_LANCZOS4)
+    resized = Image.frombytes(src.mode, size, arr.tobytes())
+    return resized.convert("RGBA") if img.mode == "RGBA" else resized
+
+
+def fit_image_to_zone(img, zone_w, zone_h, resample_filter="auto"):
+    """
+    Fit image to zone using 'contain' mode and center it.
+    
+    With resample_filter "auto", downscales of more than 3x use BILINEAR
+    (Pillow's resize is area-antialiased, so the cheaper kernel is
+    indistinguishable there) and everything else uses LANCZOS.
+    
+    When OpenCV is installed, LANCZOS resizes that shrink by at most 2x go
+    through cv2.INTER_LANCZOS4 instead. Its kernel is fixed-width (not
+    antialiased), so stronger downscales stay on Pillow.
+    
+    Args:
+        img: PIL Image object to resize
+        zone_w: Zone width in pixels
+        zone_h: Zone height in pixels
+        resample_filter: "auto" or a key of RESAMPLE_FILTERS
+        
+    Returns:
+        Tuple of (resized image, x_offset, y_offset) centering it in the zone
+    """
+    img_w, img_h = img.size
+    aspect = img_w / img_h
+    zone_aspect = zone_w / zone_h
+    
+    if aspect > zone_aspect:
+        # Image is wider - fit to width
+        new_w = zone_w
+        new_h = int(zone_w / aspect)
+    else:
+        # Image is taller - fit to height
+        new_h = zone_h
+        new_w = int(zone_h * aspect)
+    
+    if resample_filter == "auto":
+        resample = Image.Resampling.BILINEAR if img_w / new_w > 3 else Image.Resampling.LANCZOS
+    else:
+        resample = RESAMPLE_FILTERS[resample_filter]
+    if (CV2_AVAILABLE and resample == Image.Resampling.LANCZOS
+            and img.mode in ("L", "RGB", "RGBA") and img_w <= new_w * 2):
+        resized = _cv2_lanczos(img, (new_w, new_h))
+    else:
+        resized = img.resize((new_w, new_h), resample)
+    
+    x_offset, y_offset = get_centering_offset((new_w, new_h), (zone_w, zone_h))
+    return resized, x_offset, y_offset
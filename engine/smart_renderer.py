@@ -7,10 +7,12 @@ product sizing. Fixes the sizing bug by using shared utilities.
 
 from PIL import Image, ImageDraw, ImageFont, ImageFilter
 import os
+import functools
 
 from engine.image_utils import fit_image_to_box, get_centering_offset
 
 
+@functools.lru_cache(maxsize=256)
 def hex_to_rgb(hex_color):
     """Convert hex color string to RGB tuple."""
     hex_color = hex_color.lstrip('#')
@@ -52,10 +54,10 @@ def render_smart_storyboard(config, preset_name, product_mapping, customer_name=
     KEY FIX: Products are now properly fitted to container bounds using shared
     fit_image_to_box() utility, matching generate_collage.py behavior.
     """
-    # Canvas
+    # Canvas stays RGBA throughout; callers flatten to RGB when saving
     canvas_cfg = config["canvas"]
     bg_color = hex_to_rgb(canvas_cfg.get("background", "#FFFFFF"))
-    canvas = Image.new("RGB", (canvas_cfg["width_px"], canvas_cfg["height_px"]), bg_color)
+    canvas = Image.new("RGBA", (canvas_cfg["width_px"], canvas_cfg["height_px"]), bg_color + (255,))
     
     # 1. Header
     if "header" in config:
@@ -68,7 +70,7 @@ def render_smart_storyboard(config, preset_name, product_mapping, customer_name=
             try:
                 h_img = Image.open(h_cfg["src"]).convert("RGBA")
                 h_img = h_img.resize((h_area["w"], h_area["h"]), Image.Resampling.LANCZOS)
-                canvas.paste(h_img, (h_area["x"], h_area["y"]), mask=h_img)
+                canvas.alpha_composite(h_img, (h_area["x"], h_area["y"]))
             except: pass
             
         try:
@@ -98,11 +100,16 @@ def render_smart_storyboard(config, preset_name, product_mapping, customer_name=
             
         try:
             # Load product image
-            img = Image.open(img_path).convert("RGBA")
+            img = Image.open(img_path)
+            if img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA")
             
             # FIX: Use shared fit_image_to_box utility (same as generate_collage.py)
             target_w, target_h = container["w"], container["h"]
             fitted_img = fit_image_to_box(img, target_w, target_h, maintain_aspect=True)
+            if fitted_img.mode != "RGBA":
+                # Shadow and rotation need alpha; add it after the resize
+                fitted_img = fitted_img.convert("RGBA")
             
             # Rotation
             angle = container.get("rotation_deg", 0)
@@ -119,8 +126,10 @@ def render_smart_storyboard(config, preset_name, product_mapping, customer_name=
             final_x = container["x"] + x_offset - shadow_offset_x
             final_y = container["y"] + y_offset - shadow_offset_y
             
-            # Paste
-            canvas.paste(img_with_shadow, (final_x, final_y), mask=img_with_shadow)
+            # Composite in place; shadows can start left of/above the canvas,
+            # so clip the source instead of passing a negative destination
+            src_x, src_y = max(0, -final_x), max(0, -final_y)
+            canvas.alpha_composite(img_with_shadow, (final_x + src_x, final_y + src_y), (src_x, src_y))
             
             print(f"   [RENDER] Placed {cid} (fitted: {fitted_img.size})")
             
@@ -135,7 +144,7 @@ def render_smart_storyboard(config, preset_name, product_mapping, customer_name=
             try:
                 f_img = Image.open(f_cfg["src"]).convert("RGBA")
                 f_img = f_img.resize((f_area["w"], f_area["h"]), Image.Resampling.LANCZOS)
-                canvas.paste(f_img, (f_area["x"], f_area["y"]), mask=f_img)
+                canvas.alpha_composite(f_img, (f_area["x"], f_area["y"]))
             except: pass
 
     return canvas
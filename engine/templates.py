@@ -1,37 +1,84 @@
 import random
 import json
+import copy
 import math
 import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 # ==============================================================================
 # 1. FIXED LAYOUTS (Legacy JSON)
 # ==============================================================================
 import glob
 
+# Optional fast JSON decoder
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
 # ==============================================================================
 # 1. FIXED LAYOUTS (Legacy JSON + External)
 # ==============================================================================
+# Parsed + normalized template files: path -> (mtime, data)
+_LAYOUT_CACHE = {}
+# Bumped whenever a template file is (re)parsed; part of the memo signature
+_LAYOUT_GENERATION = 0
+
+def _prepare_template(data):
+    """Normalizes the containers of every layout in a template file (in place)."""
+    layouts = data["presets"].values() if "presets" in data else [data]
+    for layout in layouts:
+        if "containers" in layout:
+            layout["containers"] = prepare_legacy_containers(layout["containers"])
+
+def _load_template_cached(path):
+    """Parses a template file, reusing the previous result while its mtime is unchanged."""
+    mtime = os.path.getmtime(path)
+    cached = _LAYOUT_CACHE.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    
+    with open(path, 'rb') as f:
+        raw = f.read()
+    data = orjson.loads(raw) if ORJSON_AVAILABLE else json.loads(raw)
+    _prepare_template(data)
+    
+    global _LAYOUT_GENERATION
+    _LAYOUT_CACHE[path] = (mtime, data)
+    _LAYOUT_GENERATION += 1
+    return data
+
+def _load_one_json(path):
+    """Thread-pool worker: returns (path, data, error) instead of raising."""
+    try:
+        return path, _load_template_cached(path), None
+    except Exception as e:
+        return path, None, e
+
 def load_legacy_layouts(templates_dir="templates"):
     """Loads fixed layouts from JSON files in the templates directory."""
     presets = {}
     
     # Load External Templates (templates/*.json)
+    # Reads are I/O bound, so overlap them; merge serially to keep glob order
     ext_files = glob.glob(os.path.join(templates_dir, "*.json"))
-    for ext in ext_files:
-        try:
-            with open(ext, 'r') as f:
-                data = json.load(f)
-                
-                # Check for "presets" key (collection) or "containers" key (single layout)
-                if "presets" in data:
-                    presets.update(data["presets"])
-                elif "containers" in data:
-                    # Use filename as layout name if not a collection
-                    name = os.path.basename(ext).replace(".json", "")
-                    presets[name] = data
-                    
-        except Exception as e:
-            print(f"[WARN] Failed to load external template {ext}: {e}")
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        results = list(ex.map(_load_one_json, ext_files))
+    
+    for ext, data, error in results:
+        if error is not None:
+            print(f"[WARN] Failed to load external template {ext}: {error}")
+            continue
+            
+        # Check for "presets" key (collection) or "containers" key (single layout)
+        if "presets" in data:
+            presets.update(data["presets"])
+        elif "containers" in data:
+            # Use filename as layout name if not a collection
+            name = os.path.basename(ext).replace(".json", "")
+            presets[name] = data
             
     return presets
 
@@ -40,83 +87,92 @@ def load_legacy_layouts(templates_dir="templates"):
 # ==============================================================================
 # Each function takes (safe_area, heroes, supports, accessories, item_aspects) 
 
+# Generators emit compact immutable records; get_valid_templates converts them
+# to the renderer's dict schema at the boundary.
+Container = namedtuple('Container', 'id x y w h')
+
 def make_container(id, x, y, w, h):
-    return {"id": id, "x": int(x), "y": int(y), "w": int(w), "h": int(h)}
+    return Container(id, int(x), int(y), int(w), int(h))
 
-def layout_hero_left_grid_right(safe, heroes, supports, accessories, item_aspects={}):
-    """Archetype: Big Hero Left, Sized Grid Right"""
-    if len(heroes) != 1: return None
-    
-    containers = []
-    
-    # Hero: 45% Width
-    hero_w = int(safe['w'] * 0.45)
-    gap = int(safe['w'] * 0.05)
-    
-    containers.append(make_container(heroes[0], safe['x'], safe['y'], hero_w, safe['h']))
-    
-    # Right Sized Grid
-    # Logic: 
+def _sized_grid_boxes(gx, gy, gw, gh, gap, n_supports, n_accessories):
+    """
+    Numeric core of the hero + sized grid archetypes (no item IDs involved).
+    Returns (support_boxes, accessory_boxes) as lists of (x, y, w, h).
+    """
+    # Logic:
     # - Supports (Large/Medium) get 1 full cell.
     # - Accessories (Small/Tiny) share a cell (2 per cell).
-    
-    rx = safe['x'] + hero_w + gap
-    rw = safe['w'] - hero_w - gap
-    
-    # Calculate slots needed
-    # Each Support needs 1 slot.
-    # Accessories need 0.5 slots (ceil(count/2)).
-    slots_needed = len(supports) + math.ceil(len(accessories) / 2)
-    
-    if slots_needed == 0: return containers
+    # Each Support needs 1 slot; Accessories need 0.5 slots (ceil(count/2)).
+    slots_needed = n_supports + ((n_accessories + 1) >> 1)
+    if slots_needed == 0: return [], []
     
     cols = 2
-    rows = math.ceil(slots_needed / cols)
+    rows = (slots_needed + 1) >> 1  # ceil(slots_needed / cols)
     
-    cell_w = (rw - gap) / cols
-    cell_h = (safe['h'] - (gap * (rows-1))) / rows
+    cell_w = (gw - gap) / cols
+    cell_h = (gh - (gap * (rows-1))) / rows
     
     # Populate Grid Cells
     grid_cells = []
     for r in range(rows):
         for c in range(cols):
-            cx = rx + (c * (cell_w + gap))
-            cy = safe['y'] + (r * (cell_h + gap))
+            cx = gx + (c * (cell_w + gap))
+            cy = gy + (r * (cell_h + gap))
             grid_cells.append((cx, cy, cell_w, cell_h))
             
-    # Fill cells
-    current_cell_idx = 0
+    # 1. Supports (Full Cell)
+    support_boxes = grid_cells[:n_supports]
+    current_cell_idx = len(support_boxes)
     
-    # 1. Place Supports (Full Cell)
-    for item in supports:
-        if current_cell_idx >= len(grid_cells): break
-        cx, cy, cw, ch = grid_cells[current_cell_idx]
-        containers.append(make_container(item, cx, cy, cw, ch))
-        current_cell_idx += 1
-        
-    # 2. Place Accessories (Split Cell)
+    # 2. Accessories (Split Cell)
+    accessory_boxes = []
     acc_idx = 0
-    while acc_idx < len(accessories):
+    while acc_idx < n_accessories:
         if current_cell_idx >= len(grid_cells): break
         
-        # Take the cell
         cx, cy, cw, ch = grid_cells[current_cell_idx]
         
-        # Determine how many items to put here (1 or 2)
-        remaining_acc = len(accessories) - acc_idx
-        
-        if remaining_acc >= 2:
-            # Split Vertically (Top/Bottom)
-            sh = (ch - 20) / 2
-            containers.append(make_container(accessories[acc_idx], cx, cy, cw, sh))
-            containers.append(make_container(accessories[acc_idx+1], cx, cy + sh + 20, cw, sh))
+        if n_accessories - acc_idx >= 2:
+            # Split Vertically (Top/Bottom), integer math: make_container truncates anyway
+            sh = (int(ch) - 20) >> 1
+            accessory_boxes.append((cx, cy, cw, sh))
+            accessory_boxes.append((cx, cy + sh + 20, cw, sh))
             acc_idx += 2
         else:
             # Just one left, put it in center
-            containers.append(make_container(accessories[acc_idx], cx, cy, cw, ch))
+            accessory_boxes.append((cx, cy, cw, ch))
             acc_idx += 1
             
         current_cell_idx += 1
+        
+    return support_boxes, accessory_boxes
+
+def _zip_boxes(containers, items, boxes):
+    """Attaches item IDs to numeric boxes (extra items without a box are dropped)."""
+    for item, box in zip(items, boxes):
+        containers.append(make_container(item, *box))
+
+def layout_hero_left_grid_right(safe, heroes, supports, accessories, item_aspects={}):
+    """Archetype: Big Hero Left, Sized Grid Right"""
+    if len(heroes) != 1: return None
+    
+    containers = []
+    
+    # Hero: 45% Width
+    hero_w = int(safe['w'] * 0.45)
+    gap = int(safe['w'] * 0.05)
+    
+    containers.append(make_container(heroes[0], safe['x'], safe['y'], hero_w, safe['h']))
+    
+    # Right Sized Grid
+    rx = safe['x'] + hero_w + gap
+    rw = safe['w'] - hero_w - gap
+    
+    support_boxes, accessory_boxes = _sized_grid_boxes(
+        rx, safe['y'], rw, safe['h'], gap, len(supports), len(accessories)
+    )
+    _zip_boxes(containers, supports, support_boxes)
+    _zip_boxes(containers, accessories, accessory_boxes)
             
     return containers
 
@@ -135,48 +191,11 @@ def layout_hero_right_grid_left(safe, heroes, supports, accessories, item_aspect
     # Left Sized Grid
     lw = safe['w'] - hero_w - gap
     
-    slots_needed = len(supports) + math.ceil(len(accessories) / 2)
-    if slots_needed == 0: return containers
-    
-    cols = 2
-    rows = math.ceil(slots_needed / cols)
-    cell_w = (lw - gap) / cols
-    cell_h = (safe['h'] - (gap * (rows-1))) / rows
-    
-    grid_cells = []
-    for r in range(rows):
-        for c in range(cols):
-            cx = safe['x'] + (c * (cell_w + gap))
-            cy = safe['y'] + (r * (cell_h + gap))
-            grid_cells.append((cx, cy, cell_w, cell_h))
-            
-    current_cell_idx = 0
-    
-    # 1. Place Supports (Full Cell)
-    for item in supports:
-        if current_cell_idx >= len(grid_cells): break
-        cx, cy, cw, ch = grid_cells[current_cell_idx]
-        containers.append(make_container(item, cx, cy, cw, ch))
-        current_cell_idx += 1
-        
-    # 2. Place Accessories (Split Cell)
-    acc_idx = 0
-    while acc_idx < len(accessories):
-        if current_cell_idx >= len(grid_cells): break
-        
-        cx, cy, cw, ch = grid_cells[current_cell_idx]
-        remaining_acc = len(accessories) - acc_idx
-        
-        if remaining_acc >= 2:
-            sh = (ch - 20) / 2
-            containers.append(make_container(accessories[acc_idx], cx, cy, cw, sh))
-            containers.append(make_container(accessories[acc_idx+1], cx, cy + sh + 20, cw, sh))
-            acc_idx += 2
-        else:
-            containers.append(make_container(accessories[acc_idx], cx, cy, cw, ch))
-            acc_idx += 1
-            
-        current_cell_idx += 1
+    support_boxes, accessory_boxes = _sized_grid_boxes(
+        safe['x'], safe['y'], lw, safe['h'], gap, len(supports), len(accessories)
+    )
+    _zip_boxes(containers, supports, support_boxes)
+    _zip_boxes(containers, accessories, accessory_boxes)
 
     return containers
 
@@ -286,7 +305,7 @@ def layout_quadrant_split(safe, heroes, supports, accessories, item_aspects={}):
         containers.append(make_container(extras[0], safe['x']+qw+80, safe['y']+qh+80, qw, qh))
     elif len(extras) > 1:
         # Cluster the rest in Q4
-        rows = math.ceil(len(extras)/2)
+        rows = (len(extras) + 1) >> 1
         cw = (qw - 40) / 2
         ch = (qh - (40 * (rows-1))) / rows
         
@@ -309,6 +328,17 @@ GENERATORS = [
     layout_quadrant_split
 ]
 
+# Cheap count checks (n_heroes, n_supports, n_accessories) mirroring each
+# generator's own early-return constraints, so rejected layouts are skipped
+# without calling the generator at all.
+GENERATOR_PRECONDITIONS = {
+    layout_hero_left_grid_right: lambda h, s, a: h == 1,
+    layout_hero_right_grid_left: lambda h, s, a: h == 1,
+    layout_hero_top_band_bottom: lambda h, s, a: h == 1,
+    layout_three_column_balanced: lambda h, s, a: h == 2,
+    layout_quadrant_split: lambda h, s, a: 2 <= h + s <= 3,
+}
+
 # ==============================================================================
 # 3. SELECTION LOGIC
 # ==============================================================================
@@ -333,32 +363,57 @@ def normalize_container(c):
     # Our inventory has DYNAMIC roles.
     return new_c
 
+def _fill_priority(c):
+    # Heroes first, then by Area (largest first)
+    is_hero = 0 if c.get('role') == 'hero' else 1
+    area = c.get('width_px', 0) * c.get('height_px', 0)
+    return (is_hero, -area)
+
+def prepare_legacy_containers(containers):
+    """
+    Normalizes legacy slots once at load time, caches their log aspect ratio
+    ('_log_aspect') and returns them in fill order, so map_inventory_to_legacy
+    does no per-call conversion or sorting.
+    """
+    prepared = []
+    for c in sorted(containers, key=_fill_priority):
+        slot = normalize_container(c)
+        s_w, s_h = c.get('width_px', 100), c.get('height_px', 100)
+        slot['_log_aspect'] = math.log(s_w / s_h)
+        prepared.append(slot)
+    return prepared
+
+def _mapped_slot(slot, item_key):
+    """Copy of a prepared slot assigned to an inventory item (internal keys dropped)."""
+    c = {k: v for k, v in slot.items() if k != '_log_aspect'}
+    c['id'] = item_key
+    return c
+
 def map_inventory_to_legacy(inventory, legacy_containers, item_aspects={}):
     """
     Maps dynamic inventory items to fixed legacy slots using a Best-Fit strategy.
     
     Pass 1: Strict Role Match (Hero->Hero, Support->Support, Acc->Acc)
     Pass 2: Promotion (Accessory -> Support, Support -> Hero) to fill gaps.
+    
+    Expects slots prepared by prepare_legacy_containers, i.e. already in fill
+    order (load_legacy_layouts does this when the template is loaded).
     """
     
     # 1. Check constraints: Hero count
     template_hero_slots = [c for c in legacy_containers if c.get('role') == 'hero']
-    inventory_heroes = [k for k in inventory.keys() if 'hero' in k]
+    inventory_heroes = [k for k in inventory.keys() if k.startswith('hero')]
     
     if len(template_hero_slots) != len(inventory_heroes):
         return None
         
     mapped = []
     available_items = list(inventory.keys())
+    log_item_aspects = {k: math.log(a) for k, a in item_aspects.items()}
     used_slots = set() # Track indices of used slots
     
-    # Sort slots to fill: Heroes first, then by Area
-    def sort_prio(c):
-        is_hero = 0 if c.get('role') == 'hero' else 1
-        area = c.get('width_px', 0) * c.get('height_px', 0)
-        return (is_hero, -area)
-        
-    sorted_slots_with_idx = sorted(enumerate(legacy_containers), key=lambda x: sort_prio(x[1]))
+    # Slots are pre-sorted at load time: Heroes first, then by Area
+    sorted_slots_with_idx = list(enumerate(legacy_containers))
     
     # -------------------------------------------------------------------------
     # PASS 1: Strict Matching
@@ -368,27 +423,27 @@ def map_inventory_to_legacy(inventory, legacy_containers, item_aspects={}):
         
         slot_role = slot.get('role', 'support')
         slot_id = slot.get('id', 'unknown')
-        s_w, s_h = slot.get('width_px', 100), slot.get('height_px', 100)
-        slot_aspect = s_w / s_h
+        log_slot = slot['_log_aspect']
+        is_tiny_slot = 'tiny' in slot.get('size_class', '').lower()
         
         best_item = None
         best_score = -float('inf')
         
         for item_key in available_items:
-            # STRICT ROLE CHECK
-            if slot_role not in item_key:
+            # STRICT ROLE CHECK (inventory keys always start with their role)
+            if not item_key.startswith(slot_role):
                 continue
                 
             score = 0
             if item_key == slot_id: score += 1000
             
-            if item_key in item_aspects:
-                diff = abs(math.log(slot_aspect / item_aspects[item_key]))
+            log_item = log_item_aspects.get(item_key)
+            if log_item is not None:
+                diff = abs(log_slot - log_item)
                 score -= (diff * 50)
                 
             # Tiny/Small Penalty
-            slot_size = slot.get('size_class', '').lower()
-            if 'tiny' in slot_size:
+            if is_tiny_slot:
                 if '_small' in item_key or '_medium' in item_key or '_large' in item_key:
                     score -= 50 # Soft Penalty
             
@@ -397,9 +452,7 @@ def map_inventory_to_legacy(inventory, legacy_containers, item_aspects={}):
                 best_item = item_key
             
         if best_item:
-            c = normalize_container(slot)
-            c['id'] = best_item
-            mapped.append(c)
+            mapped.append(_mapped_slot(slot, best_item))
             available_items.remove(best_item)
             used_slots.add(slot_idx)
 
@@ -413,6 +466,7 @@ def map_inventory_to_legacy(inventory, legacy_containers, item_aspects={}):
             slot_role = slot.get('role', 'support')
             # Only allow promotion TO Support or Hero slots
             if slot_role not in ['support', 'hero']: continue
+            log_slot = slot['_log_aspect']
             
             # Logic: Can an Accessory fill a Support slot? YES.
             # Can a Support fill a Hero slot? NO (Heroes are strict).
@@ -422,7 +476,7 @@ def map_inventory_to_legacy(inventory, legacy_containers, item_aspects={}):
             
             for item_key in available_items:
                 # RELAXED CHECK: Allow Accessories in Support Slots
-                is_accessory = 'accessory' in item_key
+                is_accessory = item_key.startswith('accessory')
                 if slot_role == 'support' and is_accessory:
                     # Allow! But with a base penalty so it's a fallback
                     score = -500 
@@ -430,10 +484,9 @@ def map_inventory_to_legacy(inventory, legacy_containers, item_aspects={}):
                     continue # Strict no for other mismatches
                 
                 # Aspect Ratio still matters!
-                s_w, s_h = slot.get('width_px', 100), slot.get('height_px', 100)
-                slot_aspect = s_w / s_h
-                if item_key in item_aspects:
-                     diff = abs(math.log(slot_aspect / item_aspects[item_key]))
+                log_item = log_item_aspects.get(item_key)
+                if log_item is not None:
+                     diff = abs(log_slot - log_item)
                      score -= (diff * 50)
                 
                 if score > best_score:
@@ -441,39 +494,68 @@ def map_inventory_to_legacy(inventory, legacy_containers, item_aspects={}):
                     best_item = item_key
             
             if best_item:
-                c = normalize_container(slot)
-                c['id'] = best_item
-                mapped.append(c)
+                mapped.append(_mapped_slot(slot, best_item))
                 available_items.remove(best_item)
                 used_slots.add(slot_idx)
 
     return mapped
 
+# Memoized get_valid_templates results: signature -> valid options
+_VALID_TEMPLATES_CACHE = {}
+_VALID_TEMPLATES_CACHE_MAX = 128
+
 def get_valid_templates(config, inventory, item_aspects={}):
     """
     Returns a list of all valid layout configurations (list of containers) for this inventory.
+    
+    Results are memoized on the inventory keys (in order, since it decides
+    placement), the item aspects and the loaded template set. Each call gets a
+    deep copy, so callers may mutate the returned containers.
     """
+    legacy_presets = load_legacy_layouts()
+    
+    signature = (
+        tuple(inventory.keys()),
+        tuple(sorted(item_aspects.items())),
+        _LAYOUT_GENERATION,
+        tuple(legacy_presets.keys()),
+    )
+    valid_options = _VALID_TEMPLATES_CACHE.get(signature)
+    if valid_options is None:
+        valid_options = _compute_valid_templates(inventory, item_aspects, legacy_presets)
+        if len(_VALID_TEMPLATES_CACHE) >= _VALID_TEMPLATES_CACHE_MAX:
+            _VALID_TEMPLATES_CACHE.pop(next(iter(_VALID_TEMPLATES_CACHE)))
+        _VALID_TEMPLATES_CACHE[signature] = valid_options
+        
+    return copy.deepcopy(valid_options)
+
+def _compute_valid_templates(inventory, item_aspects, legacy_presets):
+    """Evaluates every flexible generator and legacy preset against the inventory."""
     valid_options = []
     
-    heroes = [k for k in inventory.keys() if 'hero' in k]
-    accessories = [k for k in inventory.keys() if 'accessory' in k]
-    supports = [k for k in inventory.keys() if 'hero' not in k and 'accessory' not in k]
+    # Inventory keys are role-prefixed (e.g. 'hero_left', 'accessory_small_2')
+    heroes = [k for k in inventory.keys() if k.startswith('hero')]
+    accessories = [k for k in inventory.keys() if k.startswith('accessory')]
+    supports = [k for k in inventory.keys() if not k.startswith(('hero', 'accessory'))]
     
     safe = {"x": 177, "y": 380, "w": 4607, "h": 2920} # Hardcoded safe area based on A3
     # ideally pass from config, but for now this is fine for templates
     
     # A. Check Flexible Generators
+    counts = (len(heroes), len(supports), len(accessories))
     for gen in GENERATORS:
+        precondition = GENERATOR_PRECONDITIONS.get(gen)
+        if precondition and not precondition(*counts):
+            continue
         res = gen(safe, heroes, supports, accessories, item_aspects)
         if res:
             valid_options.append({
                 "name": f"Dynamic_{gen.__name__}",
                 "type": "dynamic",
-                "containers": res
+                "containers": [c._asdict() for c in res]
             })
             
     # B. Check Legacy JSON
-    legacy_presets = load_legacy_layouts()
     for name, preset in legacy_presets.items():
         mapped = map_inventory_to_legacy(inventory, preset.get("containers", []), item_aspects)
         if mapped:
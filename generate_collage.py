@@ -3,10 +3,14 @@ Advanced Storyboard Generator with Anchored Layout System
 Supports role-based containers, floating elements, and dynamic positioning
 """
 
+import functools
+import hashlib
 import json
 import os
 import sys
+import PIL
 from PIL import Image, ImageDraw, ImageFont
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 # Optional AI imports
@@ -17,123 +21,535 @@ try:
 except ImportError:
     AI_AVAILABLE = False
 
+# Optional torchvision for CLIP image preprocessing (falls back to CLIPProcessor)
+try:
+    from torchvision import transforms as T
+    TORCHVISION_AVAILABLE = True
+except ImportError:
+    TORCHVISION_AVAILABLE = False
+
+# Optional fast JSON parser (falls back to stdlib json)
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# Optional ONNX Runtime backend for the CLIP vision tower
+try:
+    import onnxruntime as ort
+    ONNX_AVAILABLE = True
+except ImportError:
+    ONNX_AVAILABLE = False
+
+def load_json(path):
+    """Parse a JSON file, with orjson when installed."""
+    with open(path, 'rb') as f:
+        raw = f.read()
+    return orjson.loads(raw) if ORJSON_AVAILABLE else json.loads(raw)
+
+@functools.lru_cache(maxsize=256)
 def hex_to_rgb(hex_color):
     """Convert hex color to RGB tuple."""
     hex_color = hex_color.lstrip('#')
     return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
 
-def get_smart_role(img_path, model, processor):
+# CLIP label vocabulary
+CLIP_MODEL_ID = "openai/clip-vit-base-patch32"
+LABELS = ["tea towel", "tote bag", "mug", "keyring", "magnet", "notebook", "frame", "greeting card"]
+
+# Ambiguous Group: Flat rectangular art items
+AMBIGUOUS_LABELS = ["tea towel", "magnet", "greeting card", "frame"]
+
+# On-disk cache for CLIP embeddings (label text + per-image)
+CLIP_CACHE_DIR = ".cache"
+_TEXT_EMB_CACHE = {}
+
+def _content_key(path):
+    """Cache key for an image file: hash of the model ID and the file bytes."""
+    digest = hashlib.sha1(CLIP_MODEL_ID.encode())
+    with open(path, 'rb') as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+def get_text_embeddings(model, processor):
     """
-    Determine product role using AI + Heuristics (Aspect Ratio).
-    Returns (role_id, confidence_msg)
+    Normalized CLIP text embeddings for LABELS.
+    The labels never change between images, so the text tower runs once and the
+    result is cached in memory and under CLIP_CACHE_DIR.
+    """
+    key = hashlib.sha1("|".join([CLIP_MODEL_ID] + LABELS).encode()).hexdigest()[:16]
+    if key in _TEXT_EMB_CACHE:
+        return _TEXT_EMB_CACHE[key]
+    
+    cache_path = os.path.join(CLIP_CACHE_DIR, f"clip_labels_{key}.pt")
+    text_emb = None
+    if os.path.exists(cache_path):
+        try:
+            text_emb = torch.load(cache_path)
+        except Exception as e:
+            print(f"[WARN] Ignoring unreadable label cache {cache_path}: {e}")
+    
+    if text_emb is None:
+        device = next(model.parameters()).device
+        text_inputs = processor(text=LABELS, return_tensors="pt", padding=True).to(device)
+        with torch.inference_mode():
+            text_emb = model.get_text_features(**text_inputs).float().cpu()
+        text_emb = text_emb / text_emb.norm(dim=-1, keepdim=True)
+        try:
+            os.makedirs(CLIP_CACHE_DIR, exist_ok=True)
+            torch.save(text_emb, cache_path)
+        except Exception as e:
+            print(f"[WARN] Failed to write label cache: {e}")
+    
+    _TEXT_EMB_CACHE[key] = text_emb
+    return text_emb
+
+def _write_atomic(path, write):
+    """
+    Call write(tmp_path), then move the finished file to `path`, so an
+    interrupted write never leaves a truncated file that later runs trust.
     """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
     try:
-        image = Image.open(img_path)
-        
-        # 1. AI Classification
-        labels = ["tea towel", "tote bag", "mug", "keyring", "magnet", "notebook", "frame", "greeting card"]
-        inputs = processor(text=labels, images=image, return_tensors="pt", padding=True)
-        outputs = model(**inputs)
-        probs = outputs.logits_per_image.softmax(dim=1)
-        pred_idx = probs.argmax().item()
-        ai_label = labels[pred_idx]
-        conf = probs[0][pred_idx].item()
-        
-        # 2. Heuristics (Aspect Ratio Check)
-        w, h = image.size
-        aspect = w / h
-        
-        # Ambiguous Group: Flat rectangular art items
-        ambiguous_labels = ["tea towel", "magnet", "greeting card", "frame"]
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def export_clip_to_onnx(model, path):
+    """Export the CLIP vision tower + projection (get_image_features) to ONNX."""
+    class VisionEncoder(torch.nn.Module):
+        def __init__(self, clip):
+            super().__init__()
+            self.clip = clip
         
-        role = None
-        reason = f"AI: {ai_label} ({conf:.1%})"
+        def forward(self, pixel_values):
+            return self.clip.get_image_features(pixel_values=pixel_values)
+    
+    size = model.config.vision_config.image_size
+    dummy = torch.zeros(1, 3, size, size)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    _write_atomic(path, lambda tmp_path: torch.onnx.export(
+        VisionEncoder(model).eval(), (dummy,), tmp_path,
+        input_names=["pixel_values"], output_names=["image_embeds"],
+        dynamic_axes={"pixel_values": {0: "batch"}, "image_embeds": {0: "batch"}},
+        opset_version=17
+    ))
+    return path
+
+def load_onnx_vision(model):
+    """
+    ONNX Runtime session for the vision tower, exporting the model on first use.
+    On CUDA hosts with onnxconverter-common installed the graph is converted to FP16.
+    Returns (session, fp16) or None to fall back to PyTorch.
+    The result is cached on the model itself (False if ORT is unusable), so a
+    reloaded or different model gets its own session.
+    """
+    cached = getattr(model, "_onnx_vision", None)
+    if cached is not None:
+        return cached or None
+    if not ONNX_AVAILABLE:
+        model._onnx_vision = False
+        return None
+    
+    try:
+        key = hashlib.sha1(CLIP_MODEL_ID.encode()).hexdigest()[:16]
+        fp32_path = os.path.join(CLIP_CACHE_DIR, f"clip_vision_{key}.onnx")
+        if not os.path.exists(fp32_path):
+            print("[AI] Exporting CLIP vision tower to ONNX (one-time)...")
+            export_clip_to_onnx(model, fp32_path)
         
-        if ai_label in ambiguous_labels:
-            # Use Aspect Ratio to disambiguate
-            if aspect < 0.8:
-                role = "hero_left" # Towel (Tall)
-                reason += " + Tall aspect (< 0.8)"
-            elif 0.95 <= aspect <= 1.05:
-                role = "accessory_small" # Magnet (Square)
-                reason += " + Square aspect"
-            elif 0.8 <= aspect < 0.95:
-                role = "support_medium_large" # Greeting Card (Portrait)
-                reason += " + Portrait aspect"
-            elif aspect > 1.1:
-                role = "support_large" # Frame (Landscape)
-                reason += " + Landscape aspect"
+        available = ort.get_available_providers()
+        providers = [p for p in ("CUDAExecutionProvider", "CPUExecutionProvider") if p in available]
+        model_path, fp16 = fp32_path, False
         
-        # Distinct Group
-        if role is None:
-            if ai_label == "tote bag":
-                role = "hero_right"
-            elif ai_label == "mug":
-                role = "cluster_bottom"
-            elif ai_label == "keyring":
-                role = "accessory_tiny"
-            elif ai_label == "notebook":
-                role = "support_medium"
-                
-        return role, reason
+        # FP16 only pays off on GPU tensor cores
+        if "CUDAExecutionProvider" in providers:
+            try:
+                import onnx
+                from onnxconverter_common import float16
+                fp16_path = os.path.join(CLIP_CACHE_DIR, f"clip_vision_{key}_fp16.onnx")
+                if not os.path.exists(fp16_path):
+                    fp16_model = float16.convert_float_to_float16(onnx.load(fp32_path))
+                    _write_atomic(fp16_path, lambda tmp_path: onnx.save(fp16_model, tmp_path))
+                model_path, fp16 = fp16_path, True
+            except ImportError:
+                pass
         
+        try:
+            session = ort.InferenceSession(model_path, providers=providers)
+        except Exception:
+            # An unloadable cached graph would fail every later run too; drop
+            # it so the next run re-exports, and use PyTorch for this one
+            try:
+                os.remove(model_path)
+            except OSError:
+                pass
+            raise
+        model._onnx_vision = (session, fp16)
+        print(f"[AI] CLIP vision tower served by ONNX Runtime ({'FP16' if fp16 else 'FP32'})")
     except Exception as e:
-        print(f"[WARN] Smart analysis failed for {os.path.basename(img_path)}: {e}")
-        return None, str(e)
+        print(f"[WARN] ONNX Runtime unavailable, using PyTorch: {e}")
+        model._onnx_vision = False
+    
+    return model._onnx_vision or None
 
-def discover_products_smart(products_dir):
-    """Scan directory and map products using AI."""
-    if not AI_AVAILABLE:
-        print("[WARN] AI libraries not installed. Falling back to filename match.")
-        return discover_products_filenames(products_dir)
+def get_torch_vision(model):
+    """
+    PyTorch fallback for the vision tower when ONNX Runtime is not used: eval
+    mode, FP16 on CUDA, and get_image_features wrapped in torch.compile where
+    available. Returns (image_features_fn, device, dtype), cached on the model.
+    """
+    cached = getattr(model, "_torch_vision", None)
+    if cached is not None:
+        return cached
+    
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    dtype = torch.float16 if device == "cuda" else torch.float32
+    model.to(device=device, dtype=dtype).eval()
+    
+    features_fn = model.get_image_features
+    if hasattr(torch, "compile"):
+        try:
+            # CUDA graphs ("reduce-overhead") only apply on GPU
+            features_fn = torch.compile(features_fn, mode="reduce-overhead" if device == "cuda" else "default")
+        except Exception as e:
+            print(f"[WARN] torch.compile unavailable, running CLIP eagerly: {e}")
+    
+    model._torch_vision = (features_fn, device, dtype)
+    print(f"[AI] CLIP vision tower served by PyTorch ({device}, {'FP16' if dtype == torch.float16 else 'FP32'})")
+    return model._torch_vision
+
+def clip_pixel_values(images, processor):
+    """
+    CLIP pixel_values for a list of PIL images.
+    With torchvision installed this is a Resize/CenterCrop/Normalize pipeline built
+    from the processor's own settings (cached on the processor) and run across
+    threads; otherwise CLIPProcessor.
+    """
+    if not TORCHVISION_AVAILABLE:
+        return processor(images=images, return_tensors="pt")["pixel_values"]
+    
+    transform = getattr(processor, "_clip_transform", None)
+    if transform is None:
+        image_processor = processor.image_processor
+        crop = image_processor.crop_size
+        transform = processor._clip_transform = T.Compose([
+            T.Resize(image_processor.size["shortest_edge"], interpolation=T.InterpolationMode.BICUBIC),
+            T.CenterCrop((crop["height"], crop["width"])),
+            T.ToTensor(),
+            T.Normalize(image_processor.image_mean, image_processor.image_std),
+        ])
+    
+    tensors = parallel_map(lambda img: transform(img.convert('RGB')), images)
+    for tensor in tensors:
+        if isinstance(tensor, Exception):
+            raise tensor
+    return torch.stack(tensors)
+
+def get_image_embeddings(images, model, processor, cache_keys=None):
+    """
+    Normalized CLIP image embeddings, stacked in input order.
+    Images with a cache key reuse a previously saved embedding; the rest go
+    through the vision tower in one batch.
+    """
+    cache_keys = cache_keys or [None] * len(images)
+    embeddings = [None] * len(images)
+    missing = []
+    
+    for i, key in enumerate(cache_keys):
+        cache_path = os.path.join(CLIP_CACHE_DIR, f"clip_img_{key}.pt")
+        if key and os.path.exists(cache_path):
+            try:
+                embeddings[i] = torch.load(cache_path)
+                continue
+            except Exception:
+                pass
+        missing.append(i)
+    
+    if missing:
+        pixel_values = clip_pixel_values([images[i] for i in missing], processor)
+        onnx_vision = load_onnx_vision(model)
+        if onnx_vision:
+            session, fp16 = onnx_vision
+            pixel_values = pixel_values.half() if fp16 else pixel_values
+            features = torch.from_numpy(session.run(None, {"pixel_values": pixel_values.numpy()})[0]).float()
+        else:
+            features_fn, device, dtype = get_torch_vision(model)
+            pixel_values = pixel_values.to(device=device, dtype=dtype)
+            with torch.inference_mode():
+                try:
+                    features = features_fn(pixel_values=pixel_values)
+                except Exception as e:
+                    if features_fn == model.get_image_features:
+                        raise
+                    # Compilation failures surface on the first call; stay eager from here on
+                    print(f"[WARN] torch.compile failed, running CLIP eagerly: {e}")
+                    model._torch_vision = (model.get_image_features, device, dtype)
+                    features = model.get_image_features(pixel_values=pixel_values)
+            features = features.float().cpu()
+        features = features / features.norm(dim=-1, keepdim=True)
         
-    print("\n[AI] Loading CLIP model for Smart Discovery...")
-    try:
-        model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
-        processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-    except Exception as e:
-        print(f"[ERROR] Failed to load AI model: {e}")
-        return {}
+        for row, i in enumerate(missing):
+            embeddings[i] = features[row]
+            if cache_keys[i]:
+                try:
+                    os.makedirs(CLIP_CACHE_DIR, exist_ok=True)
+                    torch.save(features[row].clone(), os.path.join(CLIP_CACHE_DIR, f"clip_img_{cache_keys[i]}.pt"))
+                except Exception as e:
+                    print(f"[WARN] Failed to write image embedding cache: {e}")
+    
+    return torch.stack(embeddings)
 
-    mapping = {}
-    print("[AI] Analyzing product images...")
+def classify_batch(images, model, processor, cache_keys=None):
+    """
+    Classify a list of PIL images against LABELS in one batch.
+    Uses cached text embeddings, so only the vision tower runs per image
+    (logits = scaled cosine similarity, the same as CLIPModel's forward).
+    Returns a list of (ai_label, confidence), one per image.
+    """
+    text_emb = get_text_embeddings(model, processor)
+    img_emb = get_image_embeddings(images, model, processor, cache_keys)
+    
+    with torch.inference_mode():
+        logits = (img_emb @ text_emb.T) * model.logit_scale.exp().item()
+    probs = logits.softmax(dim=-1)
+    pred = probs.argmax(dim=1).tolist()
+    return [(LABELS[idx], probs[i][idx].item()) for i, idx in enumerate(pred)]
+
+def filename_label(filename):
+    """
+    CLIP label named by the filename itself ("tea_towel_01.png" -> "tea towel"),
+    ignoring spaces, underscores and dashes. None if the name is not informative.
+    """
+    base = os.path.basename(filename).lower()
+    for ch in " _-":
+        base = base.replace(ch, "")
+    for label in LABELS:
+        if label.replace(" ", "") in base:
+            return label
+    return None
+
+def resolve_role(ai_label, conf, w, h, source="AI"):
+    """
+    Turn a CLIP (or filename) label into a layout role using aspect ratio heuristics.
+    Returns (role_id, confidence_msg)
+    """
+    aspect = w / h
+    
+    role = None
+    reason = f"{source}: {ai_label} ({conf:.1%})"
+    
+    if ai_label in AMBIGUOUS_LABELS:
+        # Use Aspect Ratio to disambiguate
+        if aspect < 0.8:
+            role = "hero_left" # Towel (Tall)
+            reason += " + Tall aspect (< 0.8)"
+        elif 0.95 <= aspect <= 1.05:
+            role = "accessory_small" # Magnet (Square)
+            reason += " + Square aspect"
+        elif 0.8 <= aspect < 0.95:
+            role = "support_medium_large" # Greeting Card (Portrait)
+            reason += " + Portrait aspect"
+        elif aspect > 1.1:
+            role = "support_large" # Frame (Landscape)
+            reason += " + Landscape aspect"
     
-    for filename in os.listdir(products_dir):
-        if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-            path = os.path.join(products_dir, filename)
-            role, reason = get_smart_role(path, model, processor)
+    # Distinct Group
+    if role is None:
+        if ai_label == "tote bag":
+            role = "hero_right"
+        elif ai_label == "mug":
+            role = "cluster_bottom"
+        elif ai_label == "keyring":
+            role = "accessory_tiny"
+        elif ai_label == "notebook":
+            role = "support_medium"
             
-            if role:
-                mapping[role] = filename
-                print(f"  + {filename} -> {role} [{reason}]")
-            else:
-                print(f"  ? {filename} -> Unknown [{reason}]")
+    return role, reason
+
+def parallel_map(fn, items, min_items=5):
+    """
+    Map fn over items on a thread pool (decoders release the GIL). Exceptions are
+    returned in place of results. Small inputs run serially to skip pool startup.
+    """
+    def safe(item):
+        try:
+            return fn(item)
+        except Exception as e:
+            return e
+    
+    if len(items) < min_items:
+        return [safe(item) for item in items]
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        return list(ex.map(safe, items))
+
+def _decode_for_clip(path):
+    """Decode a product as RGB (what CLIPProcessor converts to anyway) plus its cache key."""
+    return Image.open(path).convert('RGB'), _content_key(path)
+
+def discover_products_smart(products_dir, dir_files=None):
+    """
+    Scan directory and map products using AI. `dir_files` reuses an existing listing.
+    Files whose names already contain a label skip CLIP; the model is only loaded
+    if some file still needs it.
+    """
+    if not AI_AVAILABLE:
+        print("[WARN] AI libraries not installed. Falling back to filename match.")
+        return discover_products_filenames(products_dir, dir_files)
+    
+    if dir_files is None:
+        dir_files = os.listdir(products_dir)
+    candidates = [f for f in dir_files if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
+    
+    # filename -> (label, conf, w, h, source) or the error that stopped analysis
+    results = {}
+    needs_ai = []
+    for filename in candidates:
+        label = filename_label(filename)
+        if label is None:
+            needs_ai.append(filename)
+            continue
+        try:
+            # Only the header is read for the size
+            w, h = Image.open(os.path.join(products_dir, filename)).size
+            results[filename] = (label, 1.0, w, h, "Filename")
+        except Exception as e:
+            results[filename] = e
+    
+    if needs_ai:
+        print("\n[AI] Loading CLIP model for Smart Discovery...")
+        try:
+            model = CLIPModel.from_pretrained(CLIP_MODEL_ID)
+            processor = CLIPProcessor.from_pretrained(CLIP_MODEL_ID)
+        except Exception as e:
+            print(f"[ERROR] Failed to load AI model: {e}")
+            return {}
+        
+        print("[AI] Analyzing product images...")
+        
+        # Decode every product first (in parallel) so CLIP runs as one batched forward pass
+        filenames = []
+        images = []
+        cache_keys = []
+        for filename, result in zip(needs_ai, parallel_map(_decode_for_clip, [os.path.join(products_dir, f) for f in needs_ai])):
+            if isinstance(result, Exception):
+                results[filename] = result
+                continue
+            image, cache_key = result
+            images.append(image)
+            cache_keys.append(cache_key)
+            filenames.append(filename)
+        
+        if images:
+            try:
+                predictions = classify_batch(images, model, processor, cache_keys)
+            except Exception as e:
+                predictions = [e] * len(images)
+            for filename, image, prediction in zip(filenames, images, predictions):
+                if isinstance(prediction, Exception):
+                    results[filename] = prediction
+                else:
+                    results[filename] = prediction + image.size + ("AI",)
+    
+    mapping = {}
+    for filename in candidates:
+        result = results[filename]
+        if isinstance(result, Exception):
+            print(f"[WARN] Smart analysis failed for {filename}: {result}")
+            print(f"  ? {filename} -> Unknown [{result}]")
+            continue
+        
+        label, conf, w, h, source = result
+        role, reason = resolve_role(label, conf, w, h, source)
+        
+        if role:
+            mapping[role] = filename
+            print(f"  + {filename} -> {role} [{reason}]")
+        else:
+            print(f"  ? {filename} -> Unknown [{reason}]")
                 
     return mapping
 
-def discover_products_filenames(products_dir):
-    """Legacy filename-based discovery."""
+# Filename keyword -> legacy container role
+FILENAME_ROLE_MAP = {
+    "towel": "hero_left",
+    "bag": "hero_right",
+    "mug": "cluster_bottom",
+    "magnet": "accessory_small",
+    "keyring": "accessory_tiny",
+    "frame": "support_large",
+    "notebook": "support_medium",
+    "greeting": "support_medium_large"
+}
+
+def discover_products_filenames(products_dir, dir_files=None):
+    """Legacy filename-based discovery. `dir_files` reuses an existing listing."""
     mapping = {}
-    auto_map = {
-        "towel": "hero_left",
-        "bag": "hero_right",
-        "mug": "cluster_bottom",
-        "magnet": "accessory_small",
-        "keyring": "accessory_tiny",
-        "frame": "support_large",
-        "notebook": "support_medium",
-        "greeting": "support_medium_large"
-    }
+    if dir_files is None:
+        dir_files = os.listdir(products_dir) if os.path.exists(products_dir) else []
     
-    if os.path.exists(products_dir):
-        for filename in os.listdir(products_dir):
-            lower_name = filename.lower()
-            if lower_name.endswith('.png'):
-                for key, role in auto_map.items():
-                    if key in lower_name:
-                        mapping[role] = os.path.join(products_dir, filename)
+    for filename in dir_files:
+        lower_name = filename.lower()
+        if lower_name.endswith('.png'):
+            for key, role in FILENAME_ROLE_MAP.items():
+                if key in lower_name:
+                    mapping[role] = os.path.join(products_dir, filename)
     return mapping
 
+@functools.lru_cache(maxsize=8)
+def _load_image(path, mtime, mode=None, draft_size=None):
+    """Decode an image once per (path, mtime), optionally converted to `mode`."""
+    img = Image.open(path)
+    if draft_size and img.format == "JPEG":
+        # Let libjpeg DCT-scale the decode (1/2..1/8) while staying >= draft_size
+        img.draft("RGB", draft_size)
+    img.load()
+    if mode and img.mode != mode:
+        img = img.convert(mode)
+    return img
+
+def jpeg_draft_size(path, draft_size):
+    """`draft_size` for JPEG paths, None otherwise (only JPEGs can draft)."""
+    return draft_size if draft_size and path.lower().endswith(('.jpg', '.jpeg')) else None
+
+def load_image(path, mode=None, draft_size=None):
+    """
+    Cached loader for header/footer assets. The returned image is shared between
+    callers, so treat it as read-only (resize/rotate/transform all return new images).
+    `draft_size` allows JPEGs to be decoded at reduced scale when they will be
+    downsized anyway.
+    """
+    # Only JPEGs can draft; keep one cache entry for everything else
+    return _load_image(path, os.path.getmtime(path), mode, jpeg_draft_size(path, draft_size))
+
+# Sized to one storyboard's products: entries are full-resolution decodes
+@functools.lru_cache(maxsize=16)
+def _load_product(path, mtime, draft_size=None):
+    """Decode a product once, keeping only its RGBA (transparent) or RGB form."""
+    img = Image.open(path)
+    if draft_size and img.format == "JPEG":
+        img.draft("RGB", draft_size)
+    img.load()
+    if img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info:
+        return img if img.mode == 'RGBA' else img.convert('RGBA')
+    return img if img.mode == 'RGB' else img.convert('RGB')
+
+def load_product(path, draft_size=None, needs_alpha=False):
+    """
+    Cached product image ready for fitting: RGBA when it carries transparency
+    (or `needs_alpha`, e.g. for rotated corners), otherwise RGB so it can be
+    pasted without an alpha plane or a blend. Treat the result as read-only.
+    """
+    img = _load_product(path, os.path.getmtime(path), jpeg_draft_size(path, draft_size))
+    if needs_alpha and img.mode != 'RGBA':
+        # Opaque product that gets rotated: add alpha per use rather than
+        # caching a second full-resolution copy
+        return img.convert('RGBA')
+    return img
+
 def fit_image_to_box(img, max_width, max_height, maintain_aspect=True):
     """Resize image to fit within box while maintaining aspect ratio (scale up or down)."""
     if not maintain_aspect:
@@ -154,134 +570,322 @@ def fit_image_to_box(img, max_width, max_height, maintain_aspect=True):
     
     return img.resize((new_width, new_height), Image.Resampling.LANCZOS)
 
-def render_header(canvas, config, customer_name="CUSTOMER NAME"):
-    """Render header with image and text overlays."""
-    if "header" not in config:
-        return canvas
+def fit_and_rotate_image(img, max_width, max_height, rotation_deg):
+    """
+    fit_image_to_box() followed by rotate(-rotation_deg, expand=True): LANCZOS
+    fit, then a BICUBIC rotation (quarter turns are lossless transposes).
+    """
+    fitted = fit_image_to_box(img, max_width, max_height)
+    if rotation_deg % 90 == 0:
+        return fitted.rotate(-rotation_deg, expand=True)
+    return fitted.rotate(-rotation_deg, expand=True, resample=Image.Resampling.BICUBIC)
+
+def composite_at(canvas, img, x, y):
+    """
+    Alpha-composite an RGBA image onto the RGBA canvas in place, touching only
+    the image's visible (non-transparent) box. Negative offsets are clipped like
+    paste() does.
+    """
+    # Fully transparent borders blend to a no-op, so skip them
+    bbox = img.getbbox()
+    if bbox is None:
+        return
+    left, top, right, bottom = bbox
+    left, top = max(left, -x), max(top, -y)
+    if left >= right or top >= bottom:
+        return
+    canvas.alpha_composite(img, dest=(x + left, y + top), source=(left, top, right, bottom))
+
+@functools.lru_cache(maxsize=32)
+def _font(path, size):
+    """TrueType font by (path, size), loaded once; falls back to the default font."""
+    try:
+        return ImageFont.truetype(path, size)
+    except Exception:
+        return ImageFont.load_default()
+
+def _image_step(src, size, pos, ok_msg, warn_msg, skip_missing=False, flatten_palette=True):
+    """
+    Compiled paste step: `src` resized (LANCZOS) to `size` and pasted as RGB at
+    `pos`. The resized image is kept between renders until the file's mtime changes.
+    """
+    resized = {}  # mtime -> resized RGB image
+    
+    def step(canvas, draw, customer_name):
+        if skip_missing and not os.path.exists(src):
+            return
+        try:
+            mtime = os.path.getmtime(src)
+            img = resized.get(mtime)
+            if img is None:
+                # JPEGs decode at reduced scale, keeping 2x headroom for LANCZOS
+                img = load_image(src, draft_size=(size[0] * 2, size[1] * 2))
+                # Convert palette images to RGB (not RGBA) to preserve colors
+                if flatten_palette and img.mode == 'P':
+                    img = img.convert('RGB')
+                img = img.resize(size, Image.Resampling.LANCZOS)
+                # Flattened, so the RGBA canvas stays opaque
+                img = img if img.mode == 'RGB' else img.convert('RGB')
+                resized.clear()
+                resized[mtime] = img
+            canvas.paste(img, pos)
+            if ok_msg:
+                print(ok_msg)
+        except Exception as e:
+            print(f"{warn_msg}: {e}")
+    
+    return step
+
+def _text_step(text, pos, color, font_path, font_size, personalize=False):
+    """Compiled text step with font and fill resolved up front."""
+    font = _font(font_path, font_size)
+    fill = hex_to_rgb(color)
     
-    header_cfg = config["header"]
+    def step(canvas, draw, customer_name):
+        draw.text(pos, text.replace("{{CUSTOMER_NAME}}", customer_name) if personalize else text,
+                  fill=fill, font=font)
+    
+    return step
+
+def _warn_step(msg):
+    """Compiled step for a config entry that cannot render; warns on every render like before."""
+    def step(canvas, draw, customer_name):
+        print(msg)
+    return step
+
+@functools.lru_cache(maxsize=8)
+def _compile_header(header_json):
+    """
+    Resolve a header config (keyed by its JSON) into straight-line draw steps:
+    branches, geometry and fonts are worked out once per distinct config.
+    """
+    header_cfg = json.loads(header_json)
     header_area = header_cfg["area"]
+    steps = []
     
-    if header_cfg.get("type") == "image":
-        header_src = header_cfg.get("src")
-        if header_src and os.path.exists(header_src):
-            try:
-                header_img = Image.open(header_src)
-                
-                # Convert palette images to RGB (not RGBA) to preserve colors
-                if header_img.mode == 'P':
-                    header_img = header_img.convert('RGB')
-                
-                # Get width percentage (default 100%)
-                width_percent = header_cfg.get("width_percent", 100)
-                target_width = int(header_area["w"] * (width_percent / 100))
-                target_height = header_area["h"]
-                
-                # Resize to fill the header area (stretch if needed)
-                header_img = header_img.resize((target_width, target_height), Image.Resampling.LANCZOS)
-                
-                # Get position (default "left")
-                position = header_cfg.get("position", "left")
-                
-                # Calculate position
-                if position == "right":
-                    img_x = header_area["x"] + header_area["w"] - target_width
-                elif position == "center":
-                    img_x = header_area["x"] + (header_area["w"] - target_width) // 2
-                else:  # left
-                    img_x = header_area["x"]
-                
-                img_y = header_area["y"]
-                
-                # Direct paste for header
-                canvas.paste(header_img, (img_x, img_y))
-                print(f"[OK] Header image loaded: {target_width}x{target_height}")
-                
-            except Exception as e:
-                print(f"[WARN] Failed to load header image: {e}")
+    header_src = header_cfg.get("src")
+    if header_cfg.get("type") == "image" and header_src:
+        try:
+            # Get width percentage (default 100%)
+            width_percent = header_cfg.get("width_percent", 100)
+            target_width = int(header_area["w"] * (width_percent / 100))
+            target_height = header_area["h"]
+            
+            # Get position (default "left")
+            position = header_cfg.get("position", "left")
+            if position == "right":
+                img_x = header_area["x"] + header_area["w"] - target_width
+            elif position == "center":
+                img_x = header_area["x"] + (header_area["w"] - target_width) // 2
+            else:  # left
+                img_x = header_area["x"]
+            
+            # Resize to fill the header area (stretch if needed)
+            steps.append(_image_step(header_src, (target_width, target_height), (img_x, header_area["y"]),
+                                     f"[OK] Header image loaded: {target_width}x{target_height}",
+                                     "[WARN] Failed to load header image", skip_missing=True))
+        except Exception as e:
+            steps.append(_warn_step(f"[WARN] Failed to load header image: {e}"))
     
-    # Render text overlays
-    draw = ImageDraw.Draw(canvas)
+    # Text overlays
     for overlay in header_cfg.get("text_overlays", []):
-        try:
-            font = ImageFont.truetype(overlay["font"], overlay["size"])
-        except:
-            font = ImageFont.load_default()
-        
-        text = overlay["text"].replace("{{CUSTOMER_NAME}}", customer_name)
-        draw.text((overlay["x"], overlay["y"]), text, 
-                 fill=hex_to_rgb(overlay["color"]), font=font)
+        steps.append(_text_step(overlay["text"], (overlay["x"], overlay["y"]), overlay["color"],
+                                overlay.get("font"), overlay.get("size"), personalize=True))
     
-    return canvas
+    return tuple(steps)
 
-def render_footer(canvas, config):
-    """Render footer with image and elements."""
-    if "footer" not in config:
-        return canvas
-    
-    footer_cfg = config["footer"]
+@functools.lru_cache(maxsize=8)
+def _compile_footer(footer_json):
+    """Footer counterpart of _compile_header: footer image, then elements in order."""
+    footer_cfg = json.loads(footer_json)
+    steps = []
     
-    # Render footer image if specified
+    footer_src = footer_cfg.get("src")
     if footer_cfg.get("type") == "image":
-        footer_src = footer_cfg.get("src")
         footer_area = footer_cfg["area"]
-        
-        if footer_src and os.path.exists(footer_src):
-            try:
-                footer_img = Image.open(footer_src)
-                if footer_img.mode == 'P':
-                    footer_img = footer_img.convert('RGB')
-                
-                footer_img = footer_img.resize((footer_area["w"], footer_area["h"]), Image.Resampling.LANCZOS)
-                canvas.paste(footer_img, (footer_area["x"], footer_area["y"]))
-                print(f"[OK] Footer image loaded")
-            except Exception as e:
-                print(f"[WARN] Failed to load footer image: {e}")
+        if footer_src:
+            steps.append(_image_step(footer_src, (footer_area["w"], footer_area["h"]), (footer_area["x"], footer_area["y"]),
+                                     "[OK] Footer image loaded", "[WARN] Failed to load footer image", skip_missing=True))
     
-    # Render footer elements
-    draw = ImageDraw.Draw(canvas)
     for element in footer_cfg.get("elements", []):
         if element["type"] == "image":
             try:
-                elem_img = Image.open(element["src"])
-                elem_img = elem_img.resize((element["w"], element["h"]), Image.Resampling.LANCZOS)
-                canvas.paste(elem_img, (element["x"], element["y"]))
+                steps.append(_image_step(element["src"], (element["w"], element["h"]), (element["x"], element["y"]),
+                                         None, "[WARN] Failed to load footer element", flatten_palette=False))
             except Exception as e:
-                print(f"[WARN] Failed to load footer element: {e}")
+                steps.append(_warn_step(f"[WARN] Failed to load footer element: {e}"))
         
         elif element["type"] == "text":
-            try:
-                font = ImageFont.truetype(element["font"], element["size"])
-            except:
-                font = ImageFont.load_default()
-            
-            draw.text((element["x"], element["y"]), element["text"],
-                     fill=hex_to_rgb(element["color"]), font=font)
+            steps.append(_text_step(element["text"], (element["x"], element["y"]), element["color"],
+                                    element.get("font"), element.get("size")))
+    
+    return tuple(steps)
+
+def render_header(canvas, config, customer_name="CUSTOMER NAME", draw=None):
+    """Render header with image and text overlays. `draw` reuses an ImageDraw for this canvas."""
+    if "header" not in config:
+        return canvas
+    
+    draw = draw or ImageDraw.Draw(canvas)
+    for step in _compile_header(json.dumps(config["header"], sort_keys=True)):
+        step(canvas, draw, customer_name)
     
     return canvas
 
-def calculate_container_bounds(container, content_area, size_classes, placed_containers):
-    """Calculate the pixel bounds for a container based on its configuration."""
+def render_footer(canvas, config, draw=None):
+    """Render footer with image and elements. `draw` reuses an ImageDraw for this canvas."""
+    if "footer" not in config:
+        return canvas
+    
+    draw = draw or ImageDraw.Draw(canvas)
+    for step in _compile_footer(json.dumps(config["footer"], sort_keys=True)):
+        step(canvas, draw, None)
+    
+    return canvas
+
+def _bounds_anchored(container, content_area, size_class, placed_containers):
+    """Float container positioned relative to an already-placed anchor."""
+    content_w = content_area["w"]
+    content_h = content_area["h"]
+    
+    anchor_id = container["anchor_to"]
+    if anchor_id not in placed_containers:
+        print(f"[WARN] Anchor '{anchor_id}' not found for '{container['id']}'")
+        return None
+    
+    anchor_bounds = placed_containers[anchor_id]
+    anchor_side = container.get("anchor_side", "top_left")
+    offset_x_pct = container.get("offset_x_percent", 0)
+    offset_y_pct = container.get("offset_y_percent", 0)
+    
+    # Calculate anchor point
+    if "top" in anchor_side:
+        anchor_y = anchor_bounds["y"]
+    elif "bottom" in anchor_side:
+        anchor_y = anchor_bounds["y"] + anchor_bounds["h"]
+    else:  # middle
+        anchor_y = anchor_bounds["y"] + anchor_bounds["h"] // 2
+    
+    if "left" in anchor_side:
+        anchor_x = anchor_bounds["x"]
+    elif "right" in anchor_side:
+        anchor_x = anchor_bounds["x"] + anchor_bounds["w"]
+    else:  # center
+        anchor_x = anchor_bounds["x"] + anchor_bounds["w"] // 2
+    
+    # Apply offsets
+    x = anchor_x + int(content_w * (offset_x_pct / 100))
+    y = anchor_y + int(content_h * (offset_y_pct / 100))
+    
+    # Get size from size_class
+    if "fixed_width_px" in size_class:
+        w = size_class["fixed_width_px"]
+        h = size_class["fixed_height_px"]
+    else:
+        max_h_pct = size_class.get("max_height_percent", 30)
+        h = int(content_h * (max_h_pct / 100))
+        w = h  # Square by default
+    
+    return {"x": x, "y": y, "w": w, "h": h}
+
+def _bounds_absolute(container, content_area, size_class, placed_containers):
+    """Margin-based positioning with size from the size class (new system)."""
     content_x = content_area["x"]
     content_y = content_area["y"]
     content_w = content_area["w"]
     content_h = content_area["h"]
     
+    # Calculate Height based on size class limits
+    if "fixed_height_px" in size_class:
+        h = size_class["fixed_height_px"]
+    else:
+        h = int(content_h * (size_class.get("max_height_percent", 30) / 100))
+        
+    # Calculate Y
+    # Check if using bottom margin (optional future proofing)
+    if "margin_bottom_percent" in container:
+        y = content_y + content_h - h - int(content_h * (container["margin_bottom_percent"] / 100))
+    else:
+        y = content_y + int(content_h * (container.get("margin_top_percent", 0) / 100))
+
+    # Calculate Width based on size class limits (also used when only a fixed height is given, e.g. cluster)
+    if "fixed_width_px" in size_class:
+        w = size_class["fixed_width_px"]
+    else:
+        w = int(content_w * (size_class.get("max_width_percent", 35) / 100))
+
+    # Calculate X
+    if "margin_right_percent" in container:
+        # Right-aligned absolute
+        x = content_x + content_w - w - int(content_w * (container["margin_right_percent"] / 100))
+    else:
+        # Left-aligned absolute (default)
+        x = content_x + int(content_w * (container.get("margin_left_percent", 0) / 100))
+        
+    return {"x": x, "y": y, "w": w, "h": h}
+
+def _bounds_left(container, content_area, size_class, placed_containers):
+    content_w = content_area["w"]
+    content_h = content_area["h"]
+    
+    x = content_area["x"] + int(content_w * (container.get("margin_left_percent", 0) / 100))
+    y = content_area["y"] + int(content_h * (container.get("margin_top_percent", 0) / 100))
+    w = int(content_w * (container.get("max_width_percent", 35) / 100))
+    h = int(content_h * (container.get("max_height_percent", 80) / 100))
+    return {"x": x, "y": y, "w": w, "h": h}
+
+def _bounds_right(container, content_area, size_class, placed_containers):
+    content_w = content_area["w"]
+    content_h = content_area["h"]
+    
+    w = int(content_w * (container.get("max_width_percent", 35) / 100))
+    h = int(content_h * (container.get("max_height_percent", 80) / 100))
+    x = content_area["x"] + content_w - w - int(content_w * (container.get("margin_right_percent", 0) / 100))
+    y = content_area["y"] + int(content_h * (container.get("margin_top_percent", 0) / 100))
+    return {"x": x, "y": y, "w": w, "h": h}
+
+def _bounds_bottom_center(container, content_area, size_class, placed_containers):
+    content_w = content_area["w"]
+    content_h = content_area["h"]
+    
+    w = int(content_w * (container.get("max_width_percent", 65) / 100))
+    h = int(content_h * (container.get("fixed_height_percent", 15) / 100))
+    x = content_area["x"] + (content_w - w) // 2
+    y = content_area["y"] + content_h - h - int(content_h * (container.get("margin_bottom_percent", 0) / 100))
+    return {"x": x, "y": y, "w": w, "h": h}
+
+def _bounds_center(container, content_area, size_class, placed_containers):
+    """Default: 30% box centered in the content area."""
+    content_w = content_area["w"]
+    content_h = content_area["h"]
+    
+    w = int(content_w * 0.3)
+    h = int(content_h * 0.3)
+    x = content_area["x"] + (content_w - w) // 2
+    y = content_area["y"] + (content_h - h) // 2
+    return {"x": x, "y": y, "w": w, "h": h}
+
+# Bounds handlers by container "position" (anything else is centered)
+BOUNDS_HANDLERS = {
+    "absolute": _bounds_absolute,
+    "left": _bounds_left,
+    "right": _bounds_right,
+    "bottom_center": _bounds_bottom_center,
+}
+
+def calculate_container_bounds(container, content_area, size_classes, placed_containers):
+    """Calculate the pixel bounds for a container based on its configuration."""
     size_class = size_classes.get(container.get("size_class", "medium"), {})
     
     # [NEW] Check for exact pixel overrides (highest priority)
     if "canvas_x" in container and "canvas_y" in container:
-        x = container["canvas_x"]
-        y = container["canvas_y"]
-        
         # Determine width
         if "width_px" in container:
             w = container["width_px"]
         elif "fixed_width_px" in size_class:
             w = size_class["fixed_width_px"]
         else:
-             max_width_pct = size_class.get("max_width_percent", 35)
-             w = int(content_w * (max_width_pct / 100))
+            w = int(content_area["w"] * (size_class.get("max_width_percent", 35) / 100))
              
         # Determine height
         if "height_px" in container:
@@ -289,197 +893,136 @@ def calculate_container_bounds(container, content_area, size_classes, placed_con
         elif "fixed_height_px" in size_class:
             h = size_class["fixed_height_px"]
         else:
-            max_height_pct = size_class.get("max_height_percent", 30)
-            h = int(content_h * (max_height_pct / 100))
+            h = int(content_area["h"] * (size_class.get("max_height_percent", 30) / 100))
             
-        return {"x": x, "y": y, "w": w, "h": h}
+        return {"x": container["canvas_x"], "y": container["canvas_y"], "w": w, "h": h}
 
-    # Handle anchored positioning
-    if container.get("position") == "float" and container.get("anchor_to"):
-        anchor_id = container["anchor_to"]
-        if anchor_id not in placed_containers:
-            print(f"[WARN] Anchor '{anchor_id}' not found for '{container['id']}'")
-            return None
-        
-        anchor_bounds = placed_containers[anchor_id]
-        anchor_side = container.get("anchor_side", "top_left")
-        offset_x_pct = container.get("offset_x_percent", 0)
-        offset_y_pct = container.get("offset_y_percent", 0)
-        
-        # Calculate anchor point
-        if "top" in anchor_side:
-            anchor_y = anchor_bounds["y"]
-        elif "bottom" in anchor_side:
-            anchor_y = anchor_bounds["y"] + anchor_bounds["h"]
-        else:  # middle
-            anchor_y = anchor_bounds["y"] + anchor_bounds["h"] // 2
-        
-        if "left" in anchor_side:
-            anchor_x = anchor_bounds["x"]
-        elif "right" in anchor_side:
-            anchor_x = anchor_bounds["x"] + anchor_bounds["w"]
-        else:  # center
-            anchor_x = anchor_bounds["x"] + anchor_bounds["w"] // 2
-        
-        # Apply offsets
-        offset_x = int(content_w * (offset_x_pct / 100))
-        offset_y = int(content_h * (offset_y_pct / 100))
-        
-        x = anchor_x + offset_x
-        y = anchor_y + offset_y
-        
-        # Get size from size_class
-        if "fixed_width_px" in size_class:
-            w = size_class["fixed_width_px"]
-            h = size_class["fixed_height_px"]
-        else:
-            max_h_pct = size_class.get("max_height_percent", 30)
-            h = int(content_h * (max_h_pct / 100))
-            w = h  # Square by default
-        
-        return {"x": x, "y": y, "w": w, "h": h}
-    
-    # Get position for non-anchored items
     position = container.get("position", "left")
-    
-    # Handle absolute positioning (new system)
-    if position == "absolute":
-        margin_top_pct = container.get("margin_top_percent", 0)
-        
-        # Calculate Height based on size class limits
-        max_height_pct = size_class.get("max_height_percent", 30)
-        if "fixed_height_px" in size_class:
-            h = size_class["fixed_height_px"]
-        else:
-            h = int(content_h * (max_height_pct / 100))
-            
-        # Calculate Y
-        # Check if using bottom margin (optional future proofing)
-        if "margin_bottom_percent" in container:
-            margin_bottom_pct = container["margin_bottom_percent"]
-            y = content_y + content_h - h - int(content_h * (margin_bottom_pct / 100))
-        else:
-            y = content_y + int(content_h * (margin_top_pct / 100))
-
-        # Calculate Width based on size class limits
-        max_width_pct = size_class.get("max_width_percent", 35)
-        if "fixed_width_px" in size_class:
-            w = size_class["fixed_width_px"]
-        elif "fixed_height_px" in size_class:
-             # If only fixed height is given (e.g. cluster), calculate width from max_width_percent
-             w = int(content_w * (max_width_pct/100))
-        else:
-            w = int(content_w * (max_width_pct / 100))
+    if position == "float" and container.get("anchor_to"):
+        handler = _bounds_anchored
+    else:
+        handler = BOUNDS_HANDLERS.get(position, _bounds_center)
+    return handler(container, content_area, size_class, placed_containers)
 
-        # Calculate X
-        if "margin_right_percent" in container:
-            # Right-aligned absolute
-            margin_right_pct = container["margin_right_percent"]
-            x = content_x + content_w - w - int(content_w * (margin_right_pct / 100))
-        else:
-            # Left-aligned absolute (default)
-            margin_left_pct = container.get("margin_left_percent", 0)
-            x = content_x + int(content_w * (margin_left_pct / 100))
-            
-        return {"x": x, "y": y, "w": w, "h": h}
-
-    # Handle positioned containers (left, right, bottom_center, etc.)
-    if position == "left":
-        margin_left_pct = container.get("margin_left_percent", 0)
-        margin_top_pct = container.get("margin_top_percent", 0)
-        max_width_pct = container.get("max_width_percent", 35)
-        max_height_pct = container.get("max_height_percent", 80)
-        
-        x = content_x + int(content_w * (margin_left_pct / 100))
-        y = content_y + int(content_h * (margin_top_pct / 100))
-        w = int(content_w * (max_width_pct / 100))
-        h = int(content_h * (max_height_pct / 100))
-        
-    elif position == "right":
-        margin_right_pct = container.get("margin_right_percent", 0)
-        margin_top_pct = container.get("margin_top_percent", 0)
-        max_width_pct = container.get("max_width_percent", 35)
-        max_height_pct = container.get("max_height_percent", 80)
-        
-        w = int(content_w * (max_width_pct / 100))
-        h = int(content_h * (max_height_pct / 100))
-        x = content_x + content_w - w - int(content_w * (margin_right_pct / 100))
-        y = content_y + int(content_h * (margin_top_pct / 100))
-        
-    elif position == "bottom_center":
-        margin_bottom_pct = container.get("margin_bottom_percent", 0)
-        max_width_pct = container.get("max_width_percent", 65)
-        fixed_height_pct = container.get("fixed_height_percent", 15)
-        
-        w = int(content_w * (max_width_pct / 100))
-        h = int(content_h * (fixed_height_pct / 100))
-        x = content_x + (content_w - w) // 2
-        y = content_y + content_h - h - int(content_h * (margin_bottom_pct / 100))
+def _anchor_order(containers):
+    """
+    Indices of containers ordered so every anchor comes before the containers
+    anchored to it (depth-first, otherwise preserving list order; cycles are
+    left to fail the anchor lookup as before).
+    """
+    index_by_id = {c["id"]: i for i, c in enumerate(containers)}
+    order = []
+    state = {}  # index -> "visiting" | "done"
     
-    else:
-        # Default center
-        w = int(content_w * 0.3)
-        h = int(content_h * 0.3)
-        x = content_x + (content_w - w) // 2
-        y = content_y + (content_h - h) // 2
+    def visit(i):
+        if state.get(i):
+            return
+        state[i] = "visiting"
+        anchor_i = index_by_id.get(containers[i].get("anchor_to"))
+        if anchor_i is not None:
+            visit(anchor_i)
+        state[i] = "done"
+        order.append(i)
     
-    return {"x": x, "y": y, "w": w, "h": h}
+    for i in range(len(containers)):
+        visit(i)
+    return order
+
+def layout_containers(containers, content_area, size_classes):
+    """
+    Resolve pixel bounds for every container. Bounds are computed in anchor
+    dependency order, so a container may be listed before its anchor; the result
+    keeps the preset's list order (which is the z-order). Returns
+    [(container, bounds)], skipping containers whose bounds could not be resolved.
+    """
+    placed_containers = {}
+    bounds_by_index = {}
+    for i in _anchor_order(containers):
+        container = containers[i]
+        bounds = calculate_container_bounds(container, content_area, size_classes, placed_containers)
+        if not bounds:
+            continue
+        placed_containers[container["id"]] = bounds
+        bounds_by_index[i] = bounds
+    return [(c, bounds_by_index[i]) for i, c in enumerate(containers) if i in bounds_by_index]
 
-def map_products_to_containers(products_dir, containers):
-    """Auto-map product files to containers based on role."""
-    product_files = [f for f in os.listdir(products_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
+def map_products_to_containers(products_dir, containers, dir_files=None):
+    """Auto-map product files to containers based on role. `dir_files` reuses an existing listing."""
+    if dir_files is None:
+        dir_files = os.listdir(products_dir)
+    product_files = [f for f in dir_files if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
+    
+    # Candidate files per role, in directory order, lowercased once
+    # (a file may qualify for several roles; "support" takes anything)
+    lowered = [f.lower() for f in product_files]
+    role_candidates = {
+        "hero": [f for f, lf in zip(product_files, lowered) if "towel" in lf],
+        "accessory": [f for f, lf in zip(product_files, lowered) if "magnet" in lf or "keyring" in lf],
+        "support": product_files,
+        "cluster": [f for f, lf in zip(product_files, lowered) if "mug" in lf],
+    }
+    cursors = dict.fromkeys(role_candidates, 0)
     
     mapping = {}
     used_products = set()
     
+    def take(role):
+        """First unused candidate for role; cursors only move forward since used_products only grows."""
+        candidates = role_candidates[role]
+        i = cursors[role]
+        while i < len(candidates) and candidates[i] in used_products:
+            i += 1
+        cursors[role] = i
+        if i == len(candidates):
+            return None
+        used_products.add(candidates[i])
+        return candidates[i]
+    
     # Priority mapping by role
     for container in containers:
-        container_id = container["id"]
         role = container.get("role", "support")
-        
-        # Try to find a suitable product
-        for product_file in product_files:
-            if product_file in used_products:
-                continue
-            
-            # Simple heuristic matching
-            if role == "hero" and "towel" in product_file.lower():
-                mapping[container_id] = product_file
-                used_products.add(product_file)
-                break
-            elif role == "accessory" and ("magnet" in product_file.lower() or "keyring" in product_file.lower()):
-                mapping[container_id] = product_file
-                used_products.add(product_file)
-                break
-            elif role == "support":
-                mapping[container_id] = product_file
-                used_products.add(product_file)
-                break
-            elif role == "cluster" and "mug" in product_file.lower():
-                mapping[container_id] = product_file
-                used_products.add(product_file)
-                break
+        if role in role_candidates:
+            product_file = take(role)
+            if product_file:
+                mapping[container["id"]] = product_file
     
     # Fill remaining containers with unused products
     for container in containers:
         container_id = container["id"]
-        if container_id not in mapping and product_files:
-            for product_file in product_files:
-                if product_file not in used_products:
-                    mapping[container_id] = product_file
-                    used_products.add(product_file)
-                    break
+        if container_id not in mapping:
+            product_file = take("support")
+            if product_file:
+                mapping[container_id] = product_file
     
     return mapping
 
+def resolve_product_path(products_dir, product_file, ci_map):
+    """
+    Path for a mapped product, falling back to a case-insensitive match through
+    `ci_map` ({filename.lower(): filename}, built once per render).
+    """
+    product_path = os.path.join(products_dir, product_file)
+    
+    # Try to find the file if exact match doesn't exist (handle case sensitivity)
+    if not os.path.exists(product_path):
+        real_name = ci_map.get(product_file.lower())
+        if real_name:
+            product_path = os.path.join(products_dir, real_name)
+    
+    return product_path
+
 def render_storyboard(config, preset_name, customer_name, product_mapping=None, products_dir="products"):
     """Render the complete storyboard."""
     canvas_cfg = config["canvas"]
-    canvas = Image.new("RGB", (canvas_cfg["width_px"], canvas_cfg["height_px"]), 
-                      hex_to_rgb(canvas_cfg["background"]))
+    # Canvas stays RGBA for the whole render so products composite in place;
+    # callers flatten to RGB once when saving.
+    canvas = Image.new("RGBA", (canvas_cfg["width_px"], canvas_cfg["height_px"]), 
+                      hex_to_rgb(canvas_cfg["background"]) + (255,))
     
     # Render header
-    canvas = render_header(canvas, config, customer_name)
+    # One ImageDraw for all text on this canvas (products are composited in place)
+    draw = ImageDraw.Draw(canvas)
+    canvas = render_header(canvas, config, customer_name, draw)
     
     # Get preset and containers
     preset = config["presets"].get(preset_name)
@@ -491,16 +1034,21 @@ def render_storyboard(config, preset_name, customer_name, product_mapping=None,
     size_classes = config["size_classes"]
     content_area = config["content_area"]
     
+    # List the products directory once for discovery and case-insensitive lookups
+    dir_files = os.listdir(products_dir) if os.path.isdir(products_dir) else []
+    # First listing entry wins when names differ only by case
+    ci_map = {f.lower(): f for f in reversed(dir_files)}
+    
     # Map products to containers
     if product_mapping is None:
         if AI_AVAILABLE:
             print("[INFO] Using AI Smart Discovery...")
-            product_mapping = discover_products_smart(products_dir)
+            product_mapping = discover_products_smart(products_dir, dir_files)
         
         # If AI not available or found nothing, fall back to legacy
         if not product_mapping:
             print("[INFO] Using Standard Filename Mapping...")
-            product_mapping = map_products_to_containers(products_dir, containers)
+            product_mapping = map_products_to_containers(products_dir, containers, dir_files)
     
     print(f"\n2. Product mapping:")
     for container_id, product_file in product_mapping.items():
@@ -508,65 +1056,54 @@ def render_storyboard(config, preset_name, customer_name, product_mapping=None,
     
     print(f"\n3. Placing products...")
     
-    # Place products
-    placed_containers = {}
+    # Phase 1: bounds for every container, before any decoding
+    placements = layout_containers(containers, content_area, size_classes)
     
-    for container in containers:
+    # Resolve product files, then decode them all up front on a thread pool;
+    # JPEGs are drafted at 2x their target box. The placement loop below is
+    # served from load_product's cache.
+    product_paths = {cid: resolve_product_path(products_dir, f, ci_map) for cid, f in product_mapping.items() if f}
+    # Jobs are deduplicated on the same (path, draft) key _load_product caches
+    # on, so a file shared by several containers is decoded by one worker only
+    decode_jobs = {(path, jpeg_draft_size(path, (b["w"] * 2, b["h"] * 2)))
+                   for c, b in placements
+                   for path in [product_paths.get(c["id"])] if path and os.path.exists(path)}
+    # Sorted so JPEG drafts of one file decode back to back (page cache friendly)
+    parallel_map(lambda job: load_product(*job), sorted(decode_jobs))
+    
+    # Phase 2: decode and place products
+    for container, bounds in placements:
         container_id = container["id"]
         
-        # Calculate bounds
-        bounds = calculate_container_bounds(container, content_area, size_classes, placed_containers)
-        if not bounds:
-            continue
-        
-        placed_containers[container_id] = bounds
-        
         # Load and place product
         # Check both the specific assignment and fallbacks
         product_file = product_mapping.get(container_id)
         
         if product_file:
-            product_path = os.path.join(products_dir, product_file)
-            
-            # Try to find the file if exact match doesn't exist (handle case sensitivity or missing extension)
-            if not os.path.exists(product_path):
-                # Try finding a match in the directory
-                candidates = os.listdir(products_dir)
-                for cand in candidates:
-                    if cand.lower() == product_file.lower():
-                        product_path = os.path.join(products_dir, cand)
-                        break
+            product_path = product_paths[container_id]
             
             if os.path.exists(product_path):
                 try:
-                    product_img = Image.open(product_path)
-                    
-                    # Convert to RGBA for transparency
-                    if product_img.mode != 'RGBA':
-                        product_img = product_img.convert('RGBA')
+                    # Decoded (drafted for JPEGs) once per file and box; RGBA only if
+                    # the product has transparency or rotation adds transparent corners
+                    rotation = container.get("rotation_deg", 0)
+                    product_img = load_product(product_path, (bounds["w"] * 2, bounds["h"] * 2), rotation != 0)
                     
-                    # Fit to bounds
-                    product_img = fit_image_to_box(product_img, bounds["w"], bounds["h"])
+                    # Fit to bounds (rotated products are scaled and rotated in one resample)
+                    if rotation != 0:
+                        product_img = fit_and_rotate_image(product_img, bounds["w"], bounds["h"], rotation)
+                    else:
+                        product_img = fit_image_to_box(product_img, bounds["w"], bounds["h"])
                     
                     # Center within bounds
                     paste_x = bounds["x"] + (bounds["w"] - product_img.size[0]) // 2
                     paste_y = bounds["y"] + (bounds["h"] - product_img.size[1]) // 2
                     
-                    # Handle rotation if specified
-                    rotation = container.get("rotation_deg", 0)
-                    if rotation != 0:
-                        product_img = product_img.rotate(-rotation, expand=True, resample=Image.Resampling.BICUBIC)
-                        # Re-center after rotation expansion
-                        paste_x = bounds["x"] + (bounds["w"] - product_img.size[0]) // 2
-                        paste_y = bounds["y"] + (bounds["h"] - product_img.size[1]) // 2
-
-                    
-                    # Paste with transparency
-                    temp_canvas = Image.new("RGBA", canvas.size, (255, 255, 255, 0))
-                    temp_canvas.paste(product_img, (paste_x, paste_y))
-                    canvas_rgba = canvas.convert("RGBA")
-                    canvas_rgba = Image.alpha_composite(canvas_rgba, temp_canvas)
-                    canvas = canvas_rgba.convert("RGB")
+                    # Paste with transparency (opaque products are a plain copy)
+                    if product_img.mode == 'RGBA':
+                        composite_at(canvas, product_img, paste_x, paste_y)
+                    else:
+                        canvas.paste(product_img, (paste_x, paste_y))
                     
                     print(f"[OK] Placed {container_id} ({product_file}) at ({paste_x}, {paste_y})")
                     
@@ -579,13 +1116,23 @@ def render_storyboard(config, preset_name, customer_name, product_mapping=None,
 
     
     # Render footer
-    canvas = render_footer(canvas, config)
+    canvas = render_footer(canvas, config, draw)
     
     return canvas
 
 def main():
+    # Optional "--format png|webp" anywhere on the command line
+    output_format = "png"
+    if "--format" in sys.argv:
+        idx = sys.argv.index("--format")
+        output_format = sys.argv[idx + 1].lower() if idx + 1 < len(sys.argv) else ""
+        del sys.argv[idx:idx + 2]
+        if output_format not in ("png", "webp"):
+            print("[ERROR] --format must be 'png' or 'webp'.")
+            sys.exit(1)
+    
     if len(sys.argv) < 2:
-        print("Usage: python generate_collage.py <mapping_file.json> OR <preset_name> [customer_name]")
+        print("Usage: python generate_collage.py <mapping_file.json> OR <preset_name> [customer_name] [--format png|webp]")
         print("Example: python generate_collage.py classic_collage.json")
         sys.exit(1)
     
@@ -597,8 +1144,7 @@ def main():
         print(f"[ERROR] Layout configuration file '{config_file}' not found.")
         sys.exit(1)
 
-    with open(config_file, 'r') as f:
-        config = json.load(f)
+    config = load_json(config_file)
         
     # Ensure presets key exists
     if "presets" not in config:
@@ -609,13 +1155,12 @@ def main():
     template_files = glob.glob(os.path.join("templates", "*.json"))
     for t_file in template_files:
         try:
-            with open(t_file, 'r') as f:
-                t_data = json.load(f)
-                if "presets" in t_data:
-                    config["presets"].update(t_data["presets"])
-                elif "containers" in t_data:
-                    name = os.path.basename(t_file).replace(".json", "")
-                    config["presets"][name] = t_data
+            t_data = load_json(t_file)
+            if "presets" in t_data:
+                config["presets"].update(t_data["presets"])
+            elif "containers" in t_data:
+                name = os.path.basename(t_file).replace(".json", "")
+                config["presets"][name] = t_data
         except Exception as e:
             print(f"[WARN] Failed to load template {t_file}: {e}")
 
@@ -663,8 +1208,7 @@ def main():
              sys.exit(1)
              
         print(f"Loading job from {mapping_file}...")
-        with open(mapping_file, 'r') as f:
-            job_data = json.load(f)
+        job_data = load_json(mapping_file)
             
         preset_name = job_data.get("layout_preset")
         customer_name = job_data.get("customer_name", "Valued Customer")
@@ -683,6 +1227,8 @@ def main():
     print(f"   Canvas: {config['canvas']['width_px']}x{config['canvas']['height_px']} @ {config['canvas']['dpi']} DPI")
     print(f"   Preset: {preset_name}")
     print(f"   Customer: {customer_name}")
+    # Pillow-SIMD builds carry a ".postN" version suffix
+    print(f"   Pillow: {PIL.__version__}{' (SIMD)' if 'post' in PIL.__version__ else ''}")
     
     # Generate storyboard
     canvas = render_storyboard(config, preset_name, customer_name, product_mapping)
@@ -694,8 +1240,16 @@ def main():
         os.makedirs(output_dir, exist_ok=True)
         # Clean filenames for safety
         safe_customer = "".join([c for c in customer_name if c.isalpha() or c.isdigit() or c==' ']).strip().replace(' ', '_')
-        output_path = os.path.join(output_dir, f"storyboard_{preset_name}_{safe_customer}_{timestamp}.png")
-        canvas.save(output_path, "PNG", dpi=(config['canvas']['dpi'], config['canvas']['dpi']))
+        output_path = os.path.join(output_dir, f"storyboard_{preset_name}_{safe_customer}_{timestamp}.{output_format}")
+        if output_format == "webp":
+            # SIMD-accelerated encoder, far faster than PNG at print sizes
+            canvas.convert("RGB").save(output_path, "WEBP", quality=92, method=4)
+        else:
+            # zlib dominates PNG save time at A3/300 DPI; level 1 is ~3x faster for ~10% more bytes.
+            # SBG_PNG_LEVEL=6 restores Pillow's default compression for final deliverables.
+            png_level = int(os.environ.get("SBG_PNG_LEVEL", "1"))
+            canvas.convert("RGB").save(output_path, "PNG", dpi=(config['canvas']['dpi'], config['canvas']['dpi']),
+                                       compress_level=png_level, optimize=False)
         
         print(f"\n[SUCCESS] Complete! Saved to: {output_path}")
     else:
@@ -1,22 +1,63 @@
 #!/usr/bin/env python3
 """
 JSON-Based Storyboard Generator with Image Header/Footer Support
-Usage: python generate_from_json.py [layout_name] [customer_name]
+Usage: python generate_from_json.py [layout_name] [customer_name] [--fast-save|--small-file]
 Example: python generate_from_json.py layout_A "ACME Corp"
+
+--fast-save (default) writes the PNG at zlib level 1; --small-file uses
+level 9 for the smallest file at several times the encode time.
 """
 
+import functools
 import json
 import os
 import sys
+import PIL
 from PIL import Image, ImageDraw, ImageFont
 from datetime import datetime
 
 import glob
+from concurrent.futures import ThreadPoolExecutor
+
+from engine import image_cache
+
+# Optional fast JSON parser/serializer (falls back to stdlib json)
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+def load_json(path):
+    """Parse a JSON file, with orjson when installed."""
+    with open(path, 'rb') as f:
+        raw = f.read()
+    return orjson.loads(raw) if ORJSON_AVAILABLE else json.loads(raw)
+
+def save_json(obj, path):
+    """Write obj to path as 2-space indented JSON, with orjson when installed."""
+    if ORJSON_AVAILABLE:
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+    else:
+        with open(path, 'w') as f:
+            json.dump(obj, f, indent=2)
+
+_CFG_CACHE = {}  # template path -> (mtime, parsed JSON); cached data is shared, treat as read-only
+
+def _load_template(t_file):
+    """Parse a template file, reusing the cached copy while its mtime is unchanged."""
+    mtime = os.path.getmtime(t_file)
+    cached = _CFG_CACHE.get(t_file)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    t_data = load_json(t_file)
+    _CFG_CACHE[t_file] = (mtime, t_data)
+    return t_data
 
 def load_config(config_path="a3_storyboard_master.json"):
     """Load JSON configuration file and templates."""
-    with open(config_path, 'r') as f:
-        config = json.load(f)
+    config = load_json(config_path)
         
     # Ensure presets key exists
     if "presets" not in config:
@@ -26,77 +67,86 @@ def load_config(config_path="a3_storyboard_master.json"):
     template_files = glob.glob(os.path.join("templates", "*.json"))
     for t_file in template_files:
         try:
-            with open(t_file, 'r') as f:
-                t_data = json.load(f)
-                if "presets" in t_data:
-                    config["presets"].update(t_data["presets"])
-                elif "containers" in t_data:
-                    name = os.path.basename(t_file).replace(".json", "")
-                    config["presets"][name] = t_data
+            t_data = _load_template(t_file)
+            if "presets" in t_data:
+                config["presets"].update(t_data["presets"])
+            elif "containers" in t_data:
+                name = os.path.basename(t_file).replace(".json", "")
+                config["presets"][name] = t_data
         except Exception as e:
             print(f"[WARN] Failed to load template {t_file}: {e}")
             
     return config
 
+@functools.lru_cache(maxsize=256)
 def hex_to_rgb(hex_color):
     """Convert hex color to RGB tuple."""
     hex_color = hex_color.lstrip('#')
     return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
 
-def create_brush_stroke_header(width, height, bg_color="#4A90C8"):
+def brush_stroke_points(width, height, x0=0, y0=0):
     """
-    Create header with brush stroke effect programmatically.
-    No image files needed!
+    Polygon for the white brush stroke covering the right ~30% of a header of
+    the given size, offset by (x0, y0). Jagged top/bottom edges are random.
     """
     import random
     
-    # Create base image
-    header = Image.new('RGB', (width, height), bg_color)
-    draw = ImageDraw.Draw(header)
-    
     # Brush stroke starts at ~70% width
     brush_x = int(width * 0.7)
-    
-    # Create jagged edge points for brush effect
-    points = []
+    span = width - brush_x
     num_points = 15
     
-    # Top edge with irregular pattern
-    for i in range(num_points):
-        x = brush_x + (width - brush_x) * (i / num_points)
-        y = 0 + random.randint(-20, 30) * (1 if i % 2 == 0 else -1)
-        points.append((int(x), int(max(0, y))))
-    
-    # Right edge
-    points.append((width, 0))
-    points.append((width, height))
-    
-    # Bottom edge with irregular pattern
-    for i in range(num_points, 0, -1):
-        x = brush_x + (width - brush_x) * (i / num_points)
-        y = height + random.randint(-30, 20) * (1 if i % 2 == 0 else -1)
-        points.append((int(x), int(min(height, y))))
-    
-    # Close polygon
-    points.append((brush_x, height))
-    points.append((brush_x, 0))
+    # Top edge with irregular pattern, then bottom edge (right to left)
+    top = [(x0 + int(brush_x + span * (i / num_points)),
+            y0 + max(0, random.randint(-20, 30) * (1 if i % 2 == 0 else -1)))
+           for i in range(num_points)]
+    bottom = [(x0 + int(brush_x + span * (i / num_points)),
+               y0 + min(height, height + random.randint(-30, 20) * (1 if i % 2 == 0 else -1)))
+              for i in range(num_points, 0, -1)]
+    
+    # Right edge between them, then close the polygon back along brush_x
+    return (top + [(x0 + width, y0), (x0 + width, y0 + height)] + bottom
+            + [(x0 + brush_x, y0 + height), (x0 + brush_x, y0)])
+
+def create_brush_stroke_header(width, height, bg_color="#4A90C8"):
+    """
+    Create header with brush stroke effect programmatically.
+    No image files needed!
+    """
+    # Create base image
+    header = Image.new('RGB', (width, height), bg_color)
     
     # Draw white brush stroke
-    draw.polygon(points, fill='white')
+    ImageDraw.Draw(header).polygon(brush_stroke_points(width, height), fill='white')
     
     return header
 
-def render_header(canvas, config, customer_name="CUSTOMER NAME"):
-    """Render header section - supports both image and programmatic generation."""
+def draw_brush_stroke_header(canvas, area, bg_color="#4A90C8"):
+    """
+    Same as create_brush_stroke_header, drawn straight into `area` of the
+    canvas instead of through a header-sized intermediate image.
+    """
+    x, y, w, h = area["x"], area["y"], area["w"], area["h"]
+    canvas.paste(bg_color, (x, y, x + w, y + h))
+    
+    # Rasterize the stroke into a mask covering only its span, which also
+    # clips it to the header box exactly like the standalone image does
+    brush_x = int(w * 0.7)
+    stroke = Image.new('L', (w - brush_x, h), 0)
+    ImageDraw.Draw(stroke).polygon(brush_stroke_points(w, h, x0=-brush_x), fill=255)
+    canvas.paste('white', (x + brush_x, y), mask=stroke)
+
+def render_header(canvas, config, customer_name="CUSTOMER NAME", draw=None):
+    """Render header section - supports both image and programmatic generation. `draw` reuses an ImageDraw for this canvas."""
     if "header" not in config:
         return
     
     header_cfg = config["header"]
     header_area = header_cfg["area"]
+    draw = draw or ImageDraw.Draw(canvas)
     
     # Draw background color first if specified
     if "background" in header_cfg:
-        draw = ImageDraw.Draw(canvas)
         bg_color = hex_to_rgb(header_cfg["background"])
         draw.rectangle([
             (header_area["x"], header_area["y"]),
@@ -106,8 +156,7 @@ def render_header(canvas, config, customer_name="CUSTOMER NAME"):
     if header_cfg.get("type") == "programmatic" or (header_cfg.get("type") == "image" and not os.path.exists(header_cfg.get("src", ""))):
         # Generate brush stroke header programmatically
         bg_color = header_cfg.get("background", "#4A90C8")
-        header_img = create_brush_stroke_header(header_area["w"], header_area["h"], bg_color)
-        canvas.paste(header_img, (header_area["x"], header_area["y"]))
+        draw_brush_stroke_header(canvas, header_area, bg_color)
         
     elif header_cfg.get("type") == "image":
         # Load header image
@@ -141,7 +190,9 @@ def render_header(canvas, config, customer_name="CUSTOMER NAME"):
                 
                 img_y = header_area["y"]
                 
-                # Direct paste for header
+                # Direct paste for header (any alpha is dropped, keeping the canvas opaque)
+                if header_img.mode != 'RGB':
+                    header_img = header_img.convert('RGB')
                 canvas.paste(header_img, (img_x, img_y))
                 
                 print(f"[OK] Header image loaded: {target_width}x{target_height} at ({img_x}, {img_y})")
@@ -157,7 +208,6 @@ def render_header(canvas, config, customer_name="CUSTOMER NAME"):
                 traceback.print_exc()
     else:
         # Legacy drawn header
-        draw = ImageDraw.Draw(canvas)
         draw.rectangle([
             (header_area["x"], header_area["y"]),
             (header_area["x"] + header_area["w"], header_area["y"] + header_area["h"])
@@ -175,7 +225,6 @@ def render_header(canvas, config, customer_name="CUSTOMER NAME"):
                          fill=hex_to_rgb(element["color"]), font=font)
     
     # Render text overlays (for both programmatic and image headers)
-    draw = ImageDraw.Draw(canvas)
     for overlay in header_cfg.get("text_overlays", []):
         try:
             font = ImageFont.truetype("arial.ttf", overlay["size"])
@@ -188,8 +237,18 @@ def render_header(canvas, config, customer_name="CUSTOMER NAME"):
     
     return canvas
 
-def render_footer(canvas, config):
-    """Render footer section - supports both image and drawn types."""
+def paste_flattened(canvas, img, pos):
+    """
+    Composite an RGBA image at pos as if flattened onto white first: fill its
+    box white, then alpha_composite it. The RGBA canvas stays fully opaque
+    (a masked paste would blend the mask into the canvas alpha too).
+    """
+    x, y = pos
+    canvas.paste((255, 255, 255, 255), (x, y, x + img.width, y + img.height))
+    canvas.alpha_composite(img, pos)
+
+def render_footer(canvas, config, draw=None):
+    """Render footer section - supports both image and drawn types. `draw` reuses an ImageDraw for this canvas."""
     if "footer" not in config:
         return
     
@@ -205,15 +264,13 @@ def render_footer(canvas, config):
                 footer_img = Image.open(footer_src).convert("RGBA")
                 footer_img = footer_img.resize((footer_area["w"], footer_area["h"]), Image.Resampling.LANCZOS)
                 
-                # Convert to RGB for pasting
-                bg = Image.new("RGB", footer_img.size, (255, 255, 255))
-                bg.paste(footer_img, mask=footer_img.split()[3] if footer_img.mode == 'RGBA' else None)
-                canvas.paste(bg, (footer_area["x"], footer_area["y"]))
+                # Flatten onto white directly on the canvas (no intermediate buffers)
+                paste_flattened(canvas, footer_img, (footer_area["x"], footer_area["y"]))
             except Exception as e:
                 print(f"[WARN] Failed to load footer image: {e}")
     
     # Render footer elements (logo and text)
-    draw = ImageDraw.Draw(canvas)
+    draw = draw or ImageDraw.Draw(canvas)
     for element in footer_cfg.get("elements", []):
         if element["type"] == "image":
             # Logo image
@@ -223,9 +280,7 @@ def render_footer(canvas, config):
                     logo_img = Image.open(logo_src).convert("RGBA")
                     logo_img = logo_img.resize((element["w"], element["h"]), Image.Resampling.LANCZOS)
                     
-                    bg = Image.new("RGB", logo_img.size, (255, 255, 255))
-                    bg.paste(logo_img, mask=logo_img.split()[3] if logo_img.mode == 'RGBA' else None)
-                    canvas.paste(bg, (element["x"], element["y"]))
+                    paste_flattened(canvas, logo_img, (element["x"], element["y"]))
                 except Exception as e:
                     print(f"[WARN] Failed to load logo: {e}")
         elif element["type"] == "text":
@@ -268,31 +323,9 @@ def load_product_mapping(products_dir="products"):
     
     return mapping
 
-def fit_image_to_zone(img, zone_w, zone_h):
-    """
-    Fit image to zone using 'contain' mode.
-    Returns resized image and offset for centering.
-    """
-    img_w, img_h = img.size
-    aspect = img_w / img_h
-    zone_aspect = zone_w / zone_h
-    
-    if aspect > zone_aspect:
-        # Image is wider - fit to width
-        new_w = zone_w
-        new_h = int(zone_w / aspect)
-    else:
-        # Image is taller - fit to height
-        new_h = zone_h
-        new_w = int(zone_h * aspect)
-    
-    resized = img.resize((new_w, new_h), Image.Resampling.LANCZOS)
-    
-    # Calculate centering offset
-    x_offset = (zone_w - new_w) // 2
-    y_offset = (zone_h - new_h) // 2
-    
-    return resized, x_offset, y_offset
+def prepare_zone(product_path, zone_w, zone_h, resample_filter="auto"):
+    """Decode and fit one zone's product. Returns (fitted_img, x_off, y_off)."""
+    return image_cache.get_fitted(product_path, zone_w, zone_h, resample_filter)
 
 def render_storyboard(config, layout_name, product_mapping, customer_name="CUSTOMER NAME"):
     """Generate storyboard from JSON config with specified layout."""
@@ -304,78 +337,81 @@ def render_storyboard(config, layout_name, product_mapping, customer_name="CUSTO
     
     zones = config["presets"][layout_name]
     
-    # Create canvas
+    # Zone geometry as parallel columns, read out of the dicts once; the
+    # submit and composite loops below index these instead
+    zone_ids = [z["id"] for z in zones]
+    xs = [z["x"] for z in zones]
+    ys = [z["y"] for z in zones]
+    ws = [z["w"] for z in zones]
+    hs = [z["h"] for z in zones]
+    
+    # Create canvas (RGBA for the whole pipeline; main() flattens once at save)
     canvas_cfg = config["canvas"]
     bg_color = hex_to_rgb(canvas_cfg.get("background", "#FFFFFF"))
-    canvas = Image.new("RGB", 
+    canvas = Image.new("RGBA", 
                       (canvas_cfg["width_px"], canvas_cfg["height_px"]),
-                      bg_color)
+                      bg_color + (255,))
     
-    # Render header
-    render_header(canvas, config, customer_name)
+    # One draw context for every header/footer section
+    draw = ImageDraw.Draw(canvas)
     
-    # Render product zones
-    placed_count = 0
-    for zone in zones:
-        zone_id = zone["id"]
+    # Render header
+    render_header(canvas, config, customer_name, draw=draw)
+    
+    resample_filter = config.get("resample_filter", "auto")
+    
+    # Decode + fit every mapped zone on a thread pool (Pillow's decode/resize
+    # release the GIL); compositing below stays on this thread in zone order,
+    # so overlapping zones stack exactly as listed
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        prepared = {
+            i: executor.submit(prepare_zone, product_mapping[zone_id], ws[i], hs[i], resample_filter)
+            for i, zone_id in enumerate(zone_ids) if zone_id in product_mapping
+        }
         
-        if zone_id in product_mapping:
-            product_path = product_mapping[zone_id]
-            
-            try:
-                # Load product image
-                product_img = Image.open(product_path).convert("RGBA")
-                
-                # Fit to zone
-                fitted_img, x_off, y_off = fit_image_to_zone(
-                    product_img, zone["w"], zone["h"]
-                )
-                
-                # Paste onto canvas
-                final_x = zone["x"] + x_off
-                final_y = zone["y"] + y_off
-                
-                # Preserve transparency by using alpha_composite
-                if fitted_img.mode == 'RGBA':
-                    # Create a temporary canvas section to composite onto
-                    temp_canvas = Image.new("RGBA", canvas.size, (255, 255, 255, 0))
-                    temp_canvas.paste(fitted_img, (final_x, final_y))
+        # Render product zones
+        placed_count = 0
+        for i, zone_id in enumerate(zone_ids):
+            if zone_id in product_mapping:
+                try:
+                    # Load and fit product image (cached across zones and runs)
+                    fitted_img, x_off, y_off = prepared[i].result()
                     
-                    # Convert main canvas to RGBA temporarily for compositing
-                    canvas_rgba = canvas.convert("RGBA")
-                    canvas_rgba = Image.alpha_composite(canvas_rgba, temp_canvas)
-                    canvas = canvas_rgba.convert("RGB")
-                else:
-                    canvas.paste(fitted_img, (final_x, final_y))
-                
-                placed_count += 1
-                print(f"[OK] Placed {zone_id} at ({final_x}, {final_y})")
-                
-            except Exception as e:
-                print(f"[ERROR] Failed to place {zone_id}: {e}")
-        else:
-            print(f"[WARN] No product mapped to zone: {zone_id}")
+                    # Paste onto canvas
+                    final_x = xs[i] + x_off
+                    final_y = ys[i] + y_off
+                    
+                    # Preserve transparency by using alpha_composite; fully opaque
+                    # products come back as RGB and take the plain paste
+                    if fitted_img.mode == 'RGBA':
+                        canvas.alpha_composite(fitted_img, (final_x, final_y))
+                    else:
+                        canvas.paste(fitted_img, (final_x, final_y))
+                    
+                    placed_count += 1
+                    print(f"[OK] Placed {zone_id} at ({final_x}, {final_y})")
+                    
+                except Exception as e:
+                    print(f"[ERROR] Failed to place {zone_id}: {e}")
+            else:
+                print(f"[WARN] No product mapped to zone: {zone_id}")
     
     # Render footer
-    render_footer(canvas, config)
+    render_footer(canvas, config, draw=draw)
     
     print(f"\nPlaced {placed_count}/{len(zones)} products")
     return canvas
 
 def main():
     """Main execution."""
-    # Parse command line arguments
-    layout_name = sys.argv[1] if len(sys.argv) > 1 else "layout_A"
-    customer_name = sys.argv[2] if len(sys.argv) > 2 else "CUSTOMER NAME"
-    
-    print("=" * 60)
-    print("JSON-Based Storyboard Generator")
-    print("=" * 60)
-    
-    # Load configuration
-    # Parse command line arguments
-    layout_name = sys.argv[1] if len(sys.argv) > 1 else "layout_A"
-    customer_name = sys.argv[2] if len(sys.argv) > 2 else "CUSTOMER NAME"
+    # Parse command line arguments (save and --cache-dir=DIR flags may appear anywhere)
+    args = [a for a in sys.argv[1:] if a not in ("--fast-save", "--small-file") and not a.startswith("--cache-dir=")]
+    layout_name = args[0] if len(args) > 0 else "layout_A"
+    customer_name = args[1] if len(args) > 1 else "CUSTOMER NAME"
+    png_level = 9 if "--small-file" in sys.argv else 1
+    for a in sys.argv[1:]:
+        if a.startswith("--cache-dir="):
+            image_cache.set_cache_dir(a.split("=", 1)[1])
     
     print("=" * 60)
     print("JSON-Based Storyboard Generator")
@@ -388,6 +424,8 @@ def main():
     print(f"   Available layouts: {', '.join(config['presets'].keys())}")
     print(f"   Selected layout: {layout_name}")
     print(f"   Customer: {customer_name}")
+    # Pillow-SIMD builds carry a ".postN" version suffix
+    print(f"   Pillow: {PIL.__version__}{' (SIMD)' if 'post' in PIL.__version__ else ''}")
     
     # Load product mapping
     print("\n2. Mapping products to zones...")
@@ -411,7 +449,7 @@ def main():
     os.makedirs("output", exist_ok=True)
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     output_path = f"output/storyboard_{layout_name}_{timestamp}.png"
-    canvas.save(output_path, dpi=(300, 300))
+    canvas.convert("RGB").save(output_path, dpi=(300, 300), compress_level=png_level)
     
     print(f"\n[SUCCESS] Complete! Saved to: {output_path}")
     print("=" * 60)
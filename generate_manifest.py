@@ -3,6 +3,13 @@ import json
 from google import genai
 from dotenv import load_dotenv
 
+# Optional fast JSON parser/serializer (falls back to stdlib json)
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
 load_dotenv()
 
 def generate_manifest():
@@ -61,10 +68,16 @@ def generate_manifest():
     # Save to file (naively parsing for now, assuming valid json from flash-latest)
     try:
         text = response.text.replace('```json', '').replace('```', '').strip()
-        manifest = json.loads(text)
-        with open(os.path.join(prod_dir, "manifest.json"), "w") as f:
-            json.dump(manifest, f, indent=2)
-        print(f"Saved manifest to {os.path.join(prod_dir, 'manifest.json')}")
+        manifest_path = os.path.join(prod_dir, "manifest.json")
+        if ORJSON_AVAILABLE:
+            manifest = orjson.loads(text)
+            with open(manifest_path, "wb") as f:
+                f.write(orjson.dumps(manifest, option=orjson.OPT_INDENT_2))
+        else:
+            manifest = json.loads(text)
+            with open(manifest_path, "w") as f:
+                json.dump(manifest, f, indent=2)
+        print(f"Saved manifest to {manifest_path}")
     except Exception as e:
         print(f"Failed to save manifest: {e}")
 
@@ -2,15 +2,6 @@ import os
 import sys
 import json
 from datetime import datetime
-import importlib.util
-
-# Utilities to load modules without modifying them
-from engine import smart_classify
-from engine import layout_generator
-
-# Import rendering logic from generate_from_json using spec to avoid executing main() if it wasn't guarded (it is guarded, but direct import is cleaner)
-from generate_from_json import load_config
-from engine.smart_renderer import render_smart_storyboard
 
 import argparse
 
@@ -24,9 +15,21 @@ def main():
     parser.add_argument("--template", help="Force a specific layout template (e.g. layout_A_classic)")
     parser.add_argument("--flexible", action="store_true", help="Allow flexible/random placement of products within their category (e.g. swap heroes)")
     parser.add_argument("--ai-layout", action="store_true", help="Use Generative AI (Gemini) to design the layout structure dynamically")
+    save_mode = parser.add_mutually_exclusive_group()
+    save_mode.add_argument("--fast-save", dest="png_level", action="store_const", const=1, default=1, help="Write the PNG at zlib level 1 (default, fastest encode)")
+    save_mode.add_argument("--small-file", dest="png_level", action="store_const", const=9, help="Write the PNG at zlib level 9 (smallest file, slower encode)")
     
     args = parser.parse_args()
     
+    # Heavy imports (CLIP/transformers, Gemini, Pillow) are deferred until the
+    # arguments parse, so --help and usage errors return immediately
+    from engine import smart_classify
+    from engine import layout_generator
+    
+    # Config loading is shared with generate_from_json (its main() is guarded)
+    from generate_from_json import load_config, load_json, save_json
+    from engine.smart_renderer import render_smart_storyboard
+    
     customer_name = args.customer_name
     preferred_template = args.template
     flexible_mode = args.flexible
@@ -176,8 +179,7 @@ def main():
                 
                 template_data["containers"].append(template_container)
             
-            with open(template_path, "w") as f:
-                json.dump(template_data, f, indent=2)
+            save_json(template_data, template_path)
             print(f"[AI] Saved reusable template to: {template_path}")
             print(f"[AI] Reuse with: --template {template_name}")
         except Exception as e:
@@ -194,8 +196,6 @@ def main():
     preset_name = "smart_generated"
     config["presets"][preset_name] = sorted(containers, key=lambda c: c['id'])
     
-    # Product mapping is just the inventory (role -> path)
-    # The container IDs match the inventory keys
     # Product mapping is just the inventory (role -> path)
     # The container IDs match the inventory keys
     try:
@@ -205,7 +205,7 @@ def main():
         os.makedirs("output", exist_ok=True)
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         output_path = f"output/storyboard_smart_{timestamp}.png"
-        canvas.save(output_path, dpi=(300, 300))
+        canvas.convert("RGB").save(output_path, dpi=(300, 300), compress_level=args.png_level)
         
         print(f"\n[SUCCESS] Saved to: {output_path}")
         
@@ -220,8 +220,7 @@ def main():
     manifest = {}
     if os.path.exists("products/manifest.json"):
         try:
-           with open("products/manifest.json", 'r') as f:
-               manifest = json.load(f)
+           manifest = load_json("products/manifest.json")
         except: pass
         
     if manifest: